@@ -1,27 +1,71 @@
-
 """afs version tracking database"""
 
+import sys
 from avdb.__version__ import VERSION as __version__
-from avdb.__main__ import help_
-from avdb.__main__ import version_
-from avdb.__main__ import init_
-from avdb.__main__ import add_
-from avdb.__main__ import import_
-from avdb.__main__ import activate_
-from avdb.__main__ import deactivate_
-from avdb.__main__ import list_
-from avdb.__main__ import scan_
-from avdb.__main__ import report_
+
+# The subcommand functions, loaded from avdb.__main__ on first use.
+SUBCOMMANDS = (
+    'help_',
+    'version_',
+    'init_',
+    'add_',
+    'import_',
+    'activate_',
+    'deactivate_',
+    'list_',
+    'scan_',
+    'daemon_',
+    'report_',
+)
+
+# Submodules which may be used as attributes of the package, for example
+# avdb.model.init_db(), without importing them first.
+SUBMODULES = (
+    'aio',
+    'csdb',
+    'daemon',
+    'importer',
+    'ingest',
+    'lease',
+    'metrics',
+    'model',
+    'pipeline',
+    'ratelimit',
+    'resolver',
+    'rtt',
+    'rx',
+    'sources',
+    'subcmd',
+    'templates',
+)
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        import importlib
+        if name in SUBCOMMANDS:
+            return getattr(importlib.import_module('avdb.__main__'), name)
+        if name in SUBMODULES:
+            return importlib.import_module('avdb.' + name)
+        raise AttributeError("module 'avdb' has no attribute '{0}'".format(name))
+
+    def __dir__():
+        return sorted(list(globals().keys()) + list(SUBCOMMANDS) + list(SUBMODULES))
+else:
+    from avdb.__main__ import help_
+    from avdb.__main__ import version_
+    from avdb.__main__ import init_
+    from avdb.__main__ import add_
+    from avdb.__main__ import import_
+    from avdb.__main__ import activate_
+    from avdb.__main__ import deactivate_
+    from avdb.__main__ import list_
+    from avdb.__main__ import scan_
+    from avdb.__main__ import daemon_
+    from avdb.__main__ import report_
+    from avdb import model, subcmd
+    # To hush lint
+    help_, version_, init_, add_, import_, activate_, deactivate_
+    list_, scan_, daemon_, report_, model, subcmd
 
 # To hush lint
 __version__
-help_
-version_
-init_
-add_
-import_
-activate_
-deactivate_
-list_
-scan_
-report_
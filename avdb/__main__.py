@@ -21,15 +21,24 @@
 """AFS version database cli"""
 
 from __future__ import print_function
-import os, sys, datetime, re, logging, mpipe, pystache, avdb
-from sh import rxdebug
-from avdb.subcmd import subcommand, argument, usage, dispatch, config
-from avdb.model import mysql_create_db, init_db, Session, Cell, Host, Node, Version
-from avdb.csdb import readfile, parse, lookup
-from avdb.templates import template
+import os, sys, datetime, re, json, logging, time, avdb
+from avdb.subcmd import subcommand, argument, usage, dispatch, config, duration, timestamp
+from avdb.rx import probers
+
+# The database, dns and template libraries take a while to load, so they
+# are imported by the subcommands which use them. Commands such as 'avdb
+# version' start without them.
 
 log = logging.getLogger('avdb')
 
+def _as_list(value):
+    """Accept a single string or a list of strings."""
+    if value is None:
+        return []
+    elif type(value) is not list and type(value) is not tuple:
+        return [value]
+    return list(value)
+
 @subcommand()
 def help_(**kwargs):
     """Display help message"""
@@ -52,6 +61,7 @@ def version_(**kwargs):
 )
 def init_(url=None, admin='root', password=None, **kwargs):
     """Create database tables"""
+    from avdb.model import mysql_create_db, init_db
     if url is None:
         return 1
     # Create the database and tables.
@@ -89,6 +99,7 @@ def init_(url=None, admin='root', password=None, **kwargs):
     argument('--desc', help="description"))
 def add_(cell=None, desc=None, url=None, **kwargs):
     """Add a cell name to be scanned."""
+    from avdb.model import init_db, Session, Cell
     if cell is None:
         log.error("Missing cell argument")
         return 1
@@ -102,179 +113,558 @@ def add_(cell=None, desc=None, url=None, **kwargs):
     return 0
 
 @subcommand(
-    argument('csdb', nargs='+', help="url or path to CellServDB file"))
-def import_(csdb=None, name=None, url=None, **kwargs):
+    argument('csdb', nargs='+', help="url or path to CellServDB file"),
+    argument('--source', help="name to record the file as, instead of its path"),
+    argument('--force', action='store_true', help="import files even if unchanged"),
+    argument('--report', action='store_true', help="print the changes"))
+def import_(csdb=None, name=None, source=None, force=False, report=False, url=None, **kwargs):
     """Import cells from CellServDB files"""
-    if csdb is None:
-        csdb = ()
-    elif type(csdb) is not list and type(csdb) is not tuple:
-        csdb = (csdb,)
+    from avdb.model import init_db, Session
+    from avdb.importer import Importer
+    from avdb.sources import DNS, Sources
+    csdb = _as_list(csdb)
+    if source and len(csdb) > 1:
+        log.error("The --source option requires a single file")
+        return 1
+    if DNS in ([source] if source else csdb):
+        log.error("The source name '%s' is kept for the hosts found in DNS", DNS)
+        return 1
 
     init_db(url)
     session = Session()
 
-    text = []
+    importer = Importer(session)
+    sources = Sources(session, importer, force=force)
     for path in csdb:
-        text.append(readfile(path))
-    cells = parse("".join(text))
-
-    for cellname,cellinfo in cells.items():
-        if cellname == 'dynroot':
-            continue  # skip the synthetic cellname
-        cell = Cell.add(session, name=cellname, desc=cellinfo['desc'])
-        for address,hostname in cellinfo['hosts']:
-            log.info("importing cell %s host %s (%s) from csdb", cellname, hostname, address)
-            host = Host.add(session, cell=cell, address=address, name=hostname)
-            Node.add(session, host, name='ptserver', port=7002)
-            Node.add(session, host, name='vlserver', port=7003)
-    session.commit()
+        changes = sources.add(path, name=source)
+        if report:
+            print(changes.summary())
+            for line in changes.lines():
+                print(line)
+    importer.commit()
+    count = sources.finish()
+    if count:
+        log.warning("deactivated %d nodes no longer listed in a CellServDB", count)
     return 0
 
 @subcommand(
     argument('--all', action='store_true', help="activate all cells"),
-    argument('--cell', help="cell name"))
-def activate_(all=False, cell='', url=None, **kwargs):
+    argument('--cell', nargs='+', help="cell names or glob patterns"),
+    argument('--host', nargs='+', help="host addresses or subnets (CIDR)"))
+def activate_(all=False, cell=None, host=None, url=None, **kwargs):
     """Set activation status"""
+    from avdb.model import init_db, Session, Node
+    cells = _as_list(cell)
+    hosts = _as_list(host)
+    if not (all or cells or hosts):
+        log.error("Specify --all, --cell, or --host")
+        return 1
     init_db(url)
     session = Session()
-    count = 0
-    if not (all or cell):
-        log.error("Specify --all or --cell")
+    try:
+        count = Node.set_active(session, True, cells=cells, hosts=hosts)
+    except ValueError as e:
+        log.error("Invalid --host: {0}".format(e))
         return 1
-    query = session.query(Node).filter_by(active=False)
-    for node in query:
-        if all or node.cellname() == cell:
-            node.active = True
-            count += 1
     session.commit()
     log.info("activated {count} items".format(count=count))
     return 0
 
 @subcommand(
-    argument('--cell', required=True, help="cell name"))
-def deactivate_(cell='', url=None, **kwargs):
+    argument('--cell', nargs='+', help="cell names or glob patterns"),
+    argument('--host', nargs='+', help="host addresses or subnets (CIDR)"))
+def deactivate_(cell=None, host=None, url=None, **kwargs):
     """Clear activation status"""
+    from avdb.model import init_db, Session, Node
+    cells = _as_list(cell)
+    hosts = _as_list(host)
+    if not (cells or hosts):
+        log.error("Specify --cell or --host")
+        return 1
     init_db(url)
     session = Session()
-    count = 0
-    query = session.query(Node).filter_by(active=True)
-    for node in query:
-        if node.cellname() == cell:
-            node.active = False
-            count += 1
+    try:
+        count = Node.set_active(session, False, cells=cells, hosts=hosts)
+    except ValueError as e:
+        log.error("Invalid --host: {0}".format(e))
+        return 1
     session.commit()
-    log.warn("deactivated {count} items".format(count=count))
+    log.warning("deactivated {count} items".format(count=count))
     return 0
 
-@subcommand()
-def list_(url=None, **kwargs):
+def _write_records(out, format, fields, rows):
+    """Write rows in a machine readable format."""
+    def value(v):
+        if isinstance(v, (datetime.datetime, datetime.date)):
+            return v.isoformat(' ')
+        return v
+    if format == 'tsv':
+        out.write("\t".join(fields) + "\n")
+        for row in rows:
+            out.write("\t".join('' if v is None else str(value(v)) for v in row) + "\n")
+    elif format == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(dict(zip(fields, map(value, row)))) + "\n")
+    elif format == 'json':
+        out.write("[")
+        sep = "\n"
+        for row in rows:
+            out.write(sep + json.dumps(dict(zip(fields, map(value, row)))))
+            sep = ",\n"
+        out.write("\n]\n")
+
+@subcommand(
+    argument('--current', action='store_true', help="list nodes with their current versions"),
+    argument('-f', '--format', choices=['text', 'json', 'jsonl', 'tsv'], default='text', help="output format"),
+    argument('--cell', nargs='+', help="cell names or glob patterns"),
+    argument('--active', action='store_true', help="list only active nodes"))
+def list_(current=False, format='text', cell=None, active=False, url=None, **kwargs):
     """List cells"""
+    from sqlalchemy import or_
+    from avdb.model import init_db, glob_match, Session, Cell, Host, Node, NodeCurrent, VersionString
     init_db(url)
     session = Session()
-    for cell in Cell.cells(session):
-        print("name:{cell.name} desc:'{cell.desc}'".format(cell=cell))
-        for host in cell.hosts:
-            print("\thost:{host.name} address:{host.address}".format(host=host))
-            for node in host.nodes:
-                print("\t\tnode:{node.name} port:{node.port} active:{node.active}".format(node=node))
+    cells = _as_list(cell)
+    out = sys.stdout
+    if current:
+        fields = ('cell', 'address', 'node', 'port', 'active', 'version', 'first_seen', 'last_seen')
+        # The text format shows the flattened version strings.
+        version = VersionString.text if format == 'text' else VersionString.raw
+        query = session.query(NodeCurrent.cell, NodeCurrent.address, NodeCurrent.name,
+                              NodeCurrent.port, NodeCurrent.active, version,
+                              NodeCurrent.first_seen, NodeCurrent.last_seen).\
+            outerjoin(VersionString, VersionString.id == NodeCurrent.string_id)
+        if cells:
+            query = query.filter(or_(*[glob_match(NodeCurrent.cell, c) for c in cells]))
+        if active:
+            query = query.filter(NodeCurrent.active == 1)
+        query = query.order_by(NodeCurrent.cell, NodeCurrent.address, NodeCurrent.name).\
+            yield_per(1000)
+        if format != 'text':
+            _write_records(out, format, fields, query)
+            return 0
+        for cellname,address,name,port,active_,version,first_seen,last_seen in query:
+            out.write("cell:{0} address:{1} node:{2} port:{3} active:{4} version:'{5}' "
+                      "last_seen:{6}\n".format(cellname, address, name, port, active_,
+                                               version or '', last_seen))
+        return 0
+
+    fields = ('cell', 'desc', 'host', 'address', 'node', 'port', 'active')
+    query = session.query(Cell.name, Cell.desc, Host.name, Host.address,
+                          Node.name, Node.port, Node.active).\
+        outerjoin(Host, Host.cell_id == Cell.id).\
+        outerjoin(Node, Node.host_id == Host.id)
+    if cells:
+        query = query.filter(or_(*[glob_match(Cell.name, c) for c in cells]))
+    if active:
+        query = query.filter(Node.active == 1)
+    query = query.order_by(Cell.name, Host.address, Node.name).yield_per(1000)
+    if format != 'text':
+        _write_records(out, format, fields, query)
+        return 0
+    last_cell = last_host = None
+    for cellname,desc,hostname,address,nodename,port,active_ in query:
+        if cellname != last_cell:
+            out.write("name:{0} desc:'{1}'\n".format(cellname, desc))
+            last_cell = cellname
+            last_host = None
+        if address is not None and address != last_host:
+            out.write("\thost:{0} address:{1}\n".format(hostname, address))
+            last_host = address
+        if nodename is not None:
+            out.write("\t\tnode:{0} port:{1} active:{2}\n".format(nodename, port, active_))
     return 0
 
 @subcommand(
-    argument('--nprocs', type=int, default=10, help="number of processes"))
-def scan_(nprocs=10, url=None, **kwargs):
+    argument('--nprocs', type=int, default=10, help="number of processes"),
+    argument('--engine', choices=['mpipe', 'async'], default='mpipe', help="probe engine"),
+    argument('--concurrency', type=int, default=1000, help="outstanding probes (async engine)"),
+    argument('--sockets', type=int, default=1, help="number of probe sockets (async engine)"),
+    argument('--prober', choices=sorted(probers.keys()), default='native', help="version probe method"),
+    argument('--timeout', type=float, default=2.0, help="seconds to wait for each probe reply from new hosts"),
+    argument('--retries', type=int, default=2, help="probe retries per node on new hosts"),
+    argument('--rate', type=float, default=0, help="probes per second in all (0 for no limit)"),
+    argument('--cell-rate', type=float, default=0, help="probes per second to each cell (0 for no limit)"),
+    argument('--subnet-rate', type=float, default=0, help="probes per second to each subnet (0 for no limit)"),
+    argument('--subnet-prefix', type=int, default=24, help="prefix length of the subnets limited by --subnet-rate"),
+    argument('--batch-size', type=int, default=1000, help="results saved per commit"),
+    argument('--nameservers', default=None, help="comma separated dns server addresses"),
+    argument('--dns-port', type=int, default=53, help="dns server port"),
+    argument('--cell', nargs='+', help="scan only these cells (names or glob patterns)"),
+    argument('--max-age', type=duration, help="skip nodes probed more recently than this"),
+    argument('--only-stale', action='store_true', help="skip nodes probed within --max-age (default 6h)"),
+    argument('--dns-only', action='store_true', help="look up cell hosts in dns, but do not probe"),
+    argument('--lease', action='store_true', help="claim nodes from the lease table to scan with other workers"),
+    argument('--lease-size', type=int, default=500, help="nodes claimed per lease"),
+    argument('--lease-ttl', type=duration, default='5m', help="time before an unfinished lease may be reclaimed"),
+    argument('--worker', default=None, help="worker name for leases (default: hostname:pid)"),
+    argument('--resume', action='store_true', help="continue the last unfinished scan"),
+    argument('--metrics-file', default=None, help="write scan metrics to this file"),
+    argument('--metrics-format', choices=['prometheus', 'json'], default='prometheus', help="metrics file format"))
+def scan_(nprocs=10, engine='mpipe', concurrency=1000, sockets=1, prober='native',
+          timeout=2.0, retries=2, rate=0, cell_rate=0, subnet_rate=0, subnet_prefix=24,
+          batch_size=1000, nameservers=None, dns_port=53, cell=None, max_age=None,
+          only_stale=False, dns_only=False, lease=False, lease_size=500, lease_ttl=300,
+          worker=None, resume=False, metrics_file=None, metrics_format='prometheus',
+          url=None, **kwargs):
     """Scan for versions"""
+    import gc
+    from sqlalchemy import or_
+    from avdb.model import init_db, glob_match, Session, Cell, Node, ScanRun
+    from avdb.ingest import Ingest
+    from avdb.importer import Importer
+    from avdb.resolver import Resolver
+    from avdb.pipeline import Discovery, ProcessProber, interleave, stream
+    from avdb.sources import Sources
+    from avdb.ratelimit import Limiter
+    from avdb.rtt import Estimator
+    from avdb.metrics import metrics
+    from avdb import rx
+    if engine == 'async' and prober != 'native':
+        log.error("The async engine requires the native prober")
+        return 1
+    if lease and cell:
+        log.error("The --cell option is not supported with --lease")
+        return 1
+    if resume and (lease or cell or max_age or only_stale):
+        log.error("The --resume option continues the last scan with its own options")
+        return 1
     init_db(url)
     session = Session()
+    run = None
+    if resume:
+        run = ScanRun.unfinished(session)
+        if run is None:
+            log.error("There is no unfinished scan to resume")
+            return 1
+        # The scan continues with the probe options it was started with.
+        saved = json.loads(run.options or '{}')
+        nprocs = saved.get('nprocs', nprocs)
+        engine = saved.get('engine', engine)
+        concurrency = saved.get('concurrency', concurrency)
+        sockets = saved.get('sockets', sockets)
+        prober = saved.get('prober', prober)
+        timeout = saved.get('timeout', timeout)
+        retries = saved.get('retries', retries)
+        rate = saved.get('rate', rate)
+        cell_rate = saved.get('cell_rate', cell_rate)
+        subnet_rate = saved.get('subnet_rate', subnet_rate)
+        subnet_prefix = saved.get('subnet_prefix', subnet_prefix)
+        batch_size = saved.get('batch_size', batch_size)
+        nameservers = saved.get('nameservers', nameservers)
+        dns_port = saved.get('dns_port', dns_port)
+    options = json.dumps({
+        'nprocs':nprocs, 'engine':engine, 'concurrency':concurrency, 'sockets':sockets,
+        'prober':prober, 'timeout':timeout, 'retries':retries, 'rate':rate,
+        'cell_rate':cell_rate, 'subnet_rate':subnet_rate, 'subnet_prefix':subnet_prefix,
+        'batch_size':batch_size, 'nameservers':nameservers, 'dns_port':dns_port,
+    }, sort_keys=True)
+    probe = probers[prober]
+    cells = _as_list(cell)
+    if only_stale and not max_age:
+        max_age = 6 * 3600
+    if lease and not max_age:
+        max_age = 3600 # Workers must agree which nodes are done.
+    if max_age:
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=duration(max_age))
+    else:
+        cutoff = None
 
-    def lookup_cell(cellname):
-        cellinfo = lookup(cellname)
-        return (cellname, cellinfo)
+    # Each host is probed with a timeout and retries fitted to its replies.
+    rtt = Estimator(timeout=timeout, retries=retries)
+    rtt.load(session)
 
     def get_version(value):
-        """Get the version string from the remote host."""
-        node_id,address,port = value
-        version = None
-        prefix = "AFS version:"
-        try:
-            for line in rxdebug(address, port, '-version'):
-                if line.startswith(prefix):
-                    version = line.replace(prefix,'').strip()
-        except:
-            version = None
-        return (node_id, version)
-
-    stage = mpipe.UnorderedStage(lookup_cell, nprocs)
-    pipe = mpipe.Pipeline(stage)
-    for cell in Cell.cells(session):
-        log.info("looking up hosts for cell %s", cell.name)
-        pipe.put(cell.name)
-    pipe.put(None)
-
-    for result in pipe.results():
-        cellname,cellinfo = result
-        cell = Cell.add(session, name=cellname)
-        for address,hostname in cellinfo:
-            log.info("importing cell %s host %s (%s) from dns", cellname, hostname, address)
-            host = Host.add(session, cell=cell, address=address, name=hostname)
-            Node.add(session, host, name='ptserver', port=7002)
-            Node.add(session, host, name='vlserver', port=7003)
-    session.commit()
+        """Get the version string from the remote host, with the probe timing."""
+        node_id,address,port,timeouts = value
+        if prober == 'native':
+            version,elapsed,tries = rx.probe(address, port, timeouts)
+        else:
+            version,elapsed,tries = probe(address, port, timeout=sum(timeouts)), None, 1
+        return (node_id, address, port, version, elapsed, tries)
 
-    stage = mpipe.UnorderedStage(get_version, nprocs)
-    pipe = mpipe.Pipeline(stage)
+    # The cells are probed in turn, so a high concurrency is spread over
+    # many cells and subnets.
+    limiter = Limiter(rate=rate, cell_rate=cell_rate, subnet_rate=subnet_rate,
+                      prefix=subnet_prefix)
 
-    for node in session.query(Node):
-        if node.active:
-            log.info("scanning node {node.host.address}:{node.port} "\
-                     "in {node.host.cell.name}".format(node=node))
-            pipe.put((node.id, node.host.address, node.port))
+    def probe_all(targets):
+        """Probe the targets with the selected engine; returns the results."""
+        if engine == 'async':
+            from avdb.aio import Prober
+            prober = Prober(concurrency=concurrency, timeout=timeout,
+                            retries=retries, sockets=sockets, rtt=rtt)
         else:
-            log.info("skipping inactive node {node.host.address}:{node.port} "\
-                     "in {node.host.cell.name}".format(node=node))
-    pipe.put(None)
-
-    for result in pipe.results():
-        node_id,version = result
-        node = session.query(Node).filter_by(id=node_id).one()
-        if version:
-            log.info("got version from {node.host.address}:{node.port}: {version}" \
-                    .format(node=node, version=version))
-            Version.add(session, node=node, version=version)
-            if not node.active:
-                node.active = True
+            prober = ProcessProber(get_version, rtt, nprocs)
+        return stream(prober, interleave(targets, limiter))
+
+    def write_metrics():
+        if metrics_file:
+            metrics.write(metrics_file, metrics_format)
+
+    def save(results, ingest):
+        for result in results:
+            node_id,address,port,version = result
+            if version:
+                log.info("got version from %s:%s: %s", address, port, version)
+            else:
+                log.warning("could not get version from %s:%s", address, port)
+            ingest.add(node_id, version)
+        ingest.flush()
+
+    if lease:
+        # DNS discovery is left to a separate 'avdb scan --dns-only' run.
+        from avdb.lease import Leases
+        leases = Leases(session, cutoff, worker=worker, size=lease_size, ttl=duration(lease_ttl))
+        leases.populate()
+        # Each worker records its own run; it probes only part of the nodes,
+        # so its counts are of its own probes.
+        run = ScanRun(started=datetime.datetime.now(), cutoff=cutoff, stage='probe',
+                      probed=0, options=options, worker=leases.worker)
+        session.add(run)
+        session.commit()
+        ingest = Ingest(session, batch_size=batch_size, rtt=rtt)
+        start = time.time()
+        interrupted = False
+        try:
+            while True:
+                targets = leases.claim()
+                if not targets:
+                    break
+                save(probe_all(targets), ingest)
+                leases.release()
+        except KeyboardInterrupt:
+            interrupted = True
+            gc.collect()
+            session.rollback()
+            ingest.flush()
+        elapsed = time.time() - start
+        run.probed = metrics.get('probes')
+        run.replies = metrics.get('probe_replies')
+        run.failures = metrics.get('probe_failures')
+        run.probe_seconds = elapsed
+        if elapsed:
+            run.nodes_per_second = run.probed / elapsed
+            metrics.set('probe_seconds', elapsed)
+            metrics.set('nodes_per_second', run.probed / elapsed)
+        if not interrupted:
+            run.stage = 'done'
+            run.finished = datetime.datetime.now()
+        session.commit()
+        write_metrics()
+        if interrupted:
+            log.warning("lease scan %d interrupted after %d nodes", run.id, run.probed)
+            return 1
+        return 0
+
+    if resume:
+        # Nodes probed since the run started are done.
+        cells = run.cells.split()
+        cutoff = run.cutoff or run.started
+        log.warning("resuming scan %d started %s", run.id, run.started)
+    else:
+        run = ScanRun(started=datetime.datetime.now(), cutoff=cutoff,
+                      cells=' '.join(cells), stage='dns', probed=0, options=options)
+        session.add(run)
+        session.commit()
+
+    def finish(stage, elapsed=0.0):
+        counts = run.probe_counts(session)
+        run.probed = sum(counts.values())
+        run.replies = counts.get('ok', 0)
+        run.failures = counts.get('noreply', 0)
+        if elapsed:
+            run.probe_seconds = (run.probe_seconds or 0.0) + elapsed
+            run.nodes_per_second = run.probed / run.probe_seconds
+            metrics.set('probe_seconds', elapsed)
+            metrics.set('nodes_per_second', metrics.get('probes') / elapsed)
+        run.stage = stage
+        if stage == 'done':
+            run.finished = datetime.datetime.now()
+        session.commit()
+        write_metrics()
+
+    def targets(cellnames=None):
+        """Generate the active nodes to probe, in all the cells scanned or the named ones.
+
+        The nodes are read in chunks as the probers take them, so the first
+        probes start without waiting for the whole list.
+        """
+        for target in Node.targets(session, cells=cells, cellnames=cellnames, cutoff=cutoff):
+            log.info("scanning node %s:%s in %s", target[1], target[2], target[3])
+            yield target
+
+    discovery = None
+    if run.stage == 'dns':
+        # The nodes of each cell are probed as soon as its hosts have been
+        # looked up, while the lookups of the other cells continue.
+        if nameservers:
+            nameservers = [ns.strip() for ns in nameservers.split(',') if ns.strip()]
+        resolver = Resolver(session, nprocs=nprocs, nameservers=nameservers, port=dns_port)
+        cellnames = []
+        query = Cell.cells(session)
+        if cells:
+            query = query.filter(or_(*[glob_match(Cell.name, c) for c in cells]))
+        for cell_ in query:
+            log.info("looking up hosts for cell %s", cell_.name)
+            cellnames.append(cell_.name)
+        importer = Importer(session)
+        discovery = Discovery(resolver, importer, nodes=targets,
+                              sources=Sources(session, importer))
+
+    def dns_finished():
+        """Record the time taken by the lookups; returns False if they did not finish."""
+        if discovery is None:
+            return True
+        if discovery.seconds is None:
+            return False
+        log.info("dns cache hits %d, misses %d", resolver.hits, resolver.misses)
+        run.dns_seconds = discovery.seconds
+        metrics.set('dns_seconds', run.dns_seconds)
+        return True
+
+    if dns_only:
+        if discovery is None:
+            return 0
+        try:
+            discovery.run(cellnames)
+        except KeyboardInterrupt:
+            log.warning("scan %d interrupted; run 'avdb scan --resume' to continue", run.id)
+            return 1
+        finally:
+            resolver.close()
+        if not dns_finished():
+            finish('dns')
+            return 1
+        finish('done')
+        return 0
+
+    ingest = Ingest(session, batch_size=batch_size, rtt=rtt)
+    start = time.time()
+    interrupted = False
+    try:
+        if discovery is not None:
+            save(probe_all(discovery.targets(cellnames)), ingest)
         else:
-            log.warning("could not get version from {node.host.address}:{node.port}" \
-                    .format(node=node))
-            if node.active:
-                log.info("deactivating node {node.host.address}:{node.port}" \
-                    .format(node=node))
-                node.active = False
-    session.commit()
+            save(probe_all(targets()), ingest)
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        if discovery is not None:
+            resolver.close()
+    if interrupted:
+        # A query interrupted part way is left in a reference cycle with
+        # the traceback, and on sqlite holds a lock until it is freed.
+        gc.collect()
+        # Keep the results received so far; the batch may have been
+        # interrupted part way, so start it again.
+        session.rollback()
+        ingest.flush()
+        finish('probe' if dns_finished() else 'dns', time.time() - start)
+        log.warning("scan %d interrupted after %d nodes; run 'avdb scan --resume' "
+                    "to continue", run.id, run.probed)
+        return 1
+    if not dns_finished():
+        finish('dns', time.time() - start)
+        log.warning("scan %d stopped as the dns lookups failed; run 'avdb scan --resume' "
+                    "to continue", run.id)
+        return 1
+    finish('done', time.time() - start)
+    log.info("scan %d probed %d nodes in %.1f seconds (%.1f nodes per second)",
+             run.id, run.probed, run.probe_seconds or 0.0, run.nodes_per_second or 0.0)
+    return 0
+
+@subcommand(
+    argument('--min-interval', type=duration, default='1h', help="shortest time between probes of a node"),
+    argument('--max-interval', type=duration, default='7d', help="longest time between probes of a node"),
+    argument('--backoff', type=float, default=2.0, help="interval growth factor for unchanged or unreachable nodes"),
+    argument('--rate', type=float, default=10.0, help="probes per second"),
+    argument('--refresh', type=duration, default='10m', help="time between node list reloads"),
+    argument('--concurrency', type=int, default=1000, help="outstanding probes"),
+    argument('--timeout', type=float, default=2.0, help="seconds to wait for each probe reply from new hosts"),
+    argument('--retries', type=int, default=2, help="probe retries per node on new hosts"),
+    argument('--batch-size', type=int, default=1000, help="results saved per commit"),
+    argument('--flush-interval', type=duration, default='1m', help="longest time results wait to be saved"),
+    argument('--metrics-file', default=None, help="write metrics to this file periodically"),
+    argument('--metrics-format', choices=['prometheus', 'json'], default='prometheus', help="metrics file format"),
+    argument('--metrics-interval', type=duration, default='1m', help="time between metrics file updates"))
+def daemon_(min_interval=3600, max_interval=7*86400, backoff=2.0, rate=10.0, refresh=600,
+            concurrency=1000, timeout=2.0, retries=2, batch_size=1000, flush_interval=60,
+            metrics_file=None, metrics_format='prometheus', metrics_interval=60, url=None,
+            **kwargs):
+    """Scan continuously"""
+    from avdb.model import init_db, Session
+    from avdb.aio import Prober
+    from avdb.daemon import Scheduler
+    from avdb.rtt import Estimator
+    init_db(url)
+    session = Session()
+    rtt = Estimator(timeout=timeout, retries=retries)
+    rtt.load(session)
+    prober = Prober(concurrency=concurrency, timeout=timeout, retries=retries, rtt=rtt)
+    scheduler = Scheduler(session, prober, min_interval=duration(min_interval),
+                          max_interval=duration(max_interval), backoff=backoff,
+                          rate=rate, refresh=duration(refresh), batch_size=batch_size,
+                          rtt=rtt, flush_interval=duration(flush_interval))
+    if metrics_file:
+        scheduler.export_metrics(metrics_file, metrics_format, duration(metrics_interval))
+    scheduler.run()
     return 0
 
 @subcommand(
     argument('-f', '--format', choices=['csv', 'html'], default='csv', help="output format"),
-    argument('-o', '--output', help="output file"))
-def report_(format='csv', output=None, url=None, **kwargs):
+    argument('-o', '--output', help="output file"),
+    argument('--current', action='store_true', help="report only the current version of each node"),
+    argument('--at', type=timestamp, help="report the versions seen running at this date and time"))
+def report_(format='csv', output=None, current=False, at=None, url=None, **kwargs):
     """Generate version report"""
+    import pystache
+    from avdb.model import init_db, Session, Cell, Host, Node, Version, VersionString, \
+        NodeCurrent, Observation
+    from avdb.templates import template
     init_db(url)
     session = Session()
-    query = session.query(Cell, Host, Node, Version).\
-        filter(Cell.id == Host.cell_id).\
-        filter(Host.id == Node.host_id).\
-        filter(Node.id == Version.node_id).\
-        order_by(Cell.name, Host.address)
-    results = []
-    for cell,host,node,version in query:
-        results.append({'cell':cell, 'host':host, 'node':node, 'version':version})
+    if current and at:
+        log.error("Use either --current or --at.")
+        return 1
+    if at:
+        query = session.query(Cell.name, Host.address, Node.name, Observation.first_seen,
+                              VersionString.text).\
+            filter(Cell.id == Host.cell_id).\
+            filter(Host.id == Node.host_id).\
+            filter(Node.id == Observation.node_id).\
+            filter(VersionString.id == Observation.string_id).\
+            filter(Observation.at(timestamp(at))).\
+            order_by(Cell.name, Host.address).\
+            yield_per(1000)
+    elif current:
+        query = session.query(NodeCurrent.cell, NodeCurrent.address, NodeCurrent.name,
+                              NodeCurrent.first_seen, VersionString.text).\
+            filter(VersionString.id == NodeCurrent.string_id).\
+            order_by(NodeCurrent.cell, NodeCurrent.address).\
+            yield_per(1000)
+    else:
+        query = session.query(Cell.name, Host.address, Node.name, Version.added, VersionString.text).\
+            filter(Cell.id == Host.cell_id).\
+            filter(Host.id == Node.host_id).\
+            filter(Node.id == Version.node_id).\
+            filter(VersionString.id == Version.string_id).\
+            order_by(Cell.name, Host.address).\
+            yield_per(1000)
     generated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-    context = {'generated':generated, 'results':results}
     renderer = pystache.Renderer()
-    if output:
-        with open(output, 'w') as out:
-            out.write(renderer.render(template[format], context))
-    else:
-        sys.stdout.write(renderer.render(template[format], context))
+    parts = dict((k, pystache.parse(v)) for k,v in template[format].items())
+    out = open(output, 'w') if output else sys.stdout
+    try:
+        out.write(renderer.render(parts['header'], {'generated':generated}))
+        for cellname,address,nodename,added,version in query:
+            row = {'cell':cellname, 'address':address, 'node':nodename,
+                   'added':added, 'version':version}
+            out.write(renderer.render(parts['row'], row))
+        out.write(renderer.render(parts['footer'], {'generated':generated}))
+    finally:
+        if output:
+            out.close()
     return 0
 
 def main():
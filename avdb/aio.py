@@ -0,0 +1,229 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Asynchronous Rx version probes
+
+Keeps thousands of version requests outstanding on a few UDP sockets from a
+single process. Replies are matched to requests by the Rx call number.
+Requires Python 3.
+
+The event loop runs on its own thread, so replies are read as soon as they
+arrive, while targets are added and results are taken by the caller:
+
+    prober = Prober(concurrency=5000, timeout=2.0, retries=2)
+    prober.start()
+    prober.put((node_id, address, port))
+    node_id,address,port,version = prober.get()
+    prober.stop()
+
+Given an avdb.rtt.Estimator, each host is probed with its own timeout and
+retries, and its estimates are updated from the replies.
+"""
+
+import asyncio, logging, queue, random, socket, threading, time
+from avdb import rx
+from avdb.metrics import metrics
+
+log = logging.getLogger('avdb')
+
+RCVBUF_SIZE = 4 * 1024 * 1024 # Limited by the kernel, e.g. net.core.rmem_max
+
+class RxProtocol(asyncio.DatagramProtocol):
+    """Deliver version replies to the waiting probes."""
+
+    def __init__(self, pending):
+        self.pending = pending
+
+    def datagram_received(self, data, addr):
+        number = rx.call_number(data)
+        waiter = self.pending.get(number)
+        if waiter is None:
+            return # Late reply to a probe which has given up.
+        future,address = waiter
+        if addr[0] != address or future.done():
+            return
+        future.set_result(rx.parse_version_reply(data))
+
+    def error_received(self, exc):
+        log.debug("rx socket error: %s", exc)
+
+class Prober(object):
+    """Probe many nodes concurrently on a few sockets."""
+
+    def __init__(self, concurrency=1000, timeout=2.0, retries=2, sockets=1, rtt=None):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.rtt = rtt # per host timeouts and retries, if given
+        self.nsockets = max(1, sockets)
+        self.transports = []
+        self.pending = {}
+        self.counter = random.randint(1, 0xffffffff)
+        self.window = 2 * self.concurrency # targets queued by put()
+        self.thread = None
+
+    def _next_call_number(self):
+        while True:
+            self.counter = (self.counter % 0xffffffff) + 1
+            if self.counter not in self.pending:
+                return self.counter
+
+    async def _open(self):
+        loop = asyncio.get_event_loop()
+        for _ in range(self.nsockets):
+            transport,_ = await loop.create_datagram_endpoint(
+                lambda: RxProtocol(self.pending), local_addr=('0.0.0.0', 0))
+            # Replies to a burst of probes arrive together; with the default
+            # buffer size most of them are dropped.
+            sock = transport.get_extra_info('socket')
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+            except OSError as e:
+                log.debug("unable to set the receive buffer size: %s", e)
+            self.transports.append(transport)
+
+    def _close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    async def probe(self, address, port):
+        """Get the version string from the remote host, or None."""
+        loop = asyncio.get_event_loop()
+        number = self._next_call_number()
+        request = rx.version_request(number)
+        transport = self.transports[number % len(self.transports)]
+        future = loop.create_future()
+        if self.rtt is not None:
+            timeouts = self.rtt.timeouts(address)
+        else:
+            timeouts = (self.timeout,) * (self.retries + 1)
+        self.pending[number] = (future, address)
+        version = None
+        rtt = None
+        tries = 0
+        try:
+            for timeout in timeouts:
+                if tries:
+                    metrics.inc('probe_retries')
+                start = time.time()
+                transport.sendto(request, (address, port))
+                tries += 1
+                try:
+                    version = await asyncio.wait_for(asyncio.shield(future), timeout)
+                    rtt = time.time() - start
+                    metrics.observe('probe_rtt_seconds', rtt)
+                    break
+                except asyncio.TimeoutError:
+                    metrics.inc('probe_timeouts')
+                    continue
+        except OSError as e:
+            log.debug("rx version probe of %s:%s failed: %s", address, port, e)
+        finally:
+            del self.pending[number]
+        if self.rtt is not None and tries:
+            self.rtt.observe(address, rtt, tries, rtt is not None)
+        return version
+
+    def start(self):
+        """Run the probes on a new thread; add targets with put()."""
+        self.loop = asyncio.new_event_loop()
+        self.outbox = queue.Queue()
+        self.error = None
+        self.lock = threading.Lock()
+        self.incoming = [] # targets not yet handed to the event loop
+        self.waking = False
+        self.stopping = False
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(ready,), name='avdb-probe')
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            self.stop()
+            raise self.error
+
+    def _serve(self, ready):
+        loop = self.loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._open())
+            self.inbox = asyncio.Queue()
+            self.workers = [loop.create_task(self._serve_worker())
+                            for _ in range(self.concurrency)]
+            ready.set()
+            loop.run_until_complete(asyncio.gather(*self.workers, return_exceptions=True))
+        except Exception as e:
+            self.error = e
+        finally:
+            ready.set()
+            self._close()
+            loop.run_until_complete(asyncio.sleep(0)) # Let transports close.
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def _serve_worker(self):
+        while not self.stopping:
+            node_id,address,port = await self.inbox.get()
+            version = await self.probe(address, port)
+            self.outbox.put((node_id, address, port, version))
+
+    def _cancel(self):
+        # wait_for() may swallow a cancel which arrives as the reply does,
+        # so the workers also check the flag.
+        self.stopping = True
+        for worker in self.workers:
+            worker.cancel()
+
+    def _take(self):
+        with self.lock:
+            targets = self.incoming
+            self.incoming = []
+            self.waking = False
+        for target in targets:
+            self.inbox.put_nowait(target)
+
+    def put(self, target):
+        """Add a (node_id, address, port) target to be probed."""
+        # Waking the event loop is costly, so targets added before it
+        # wakes are handed over together.
+        with self.lock:
+            self.incoming.append(target)
+            if self.waking:
+                return
+            self.waking = True
+        self.loop.call_soon_threadsafe(self._take)
+
+    def get(self, timeout=None):
+        """Get the next result, or None if none arrived within the timeout."""
+        try:
+            return self.outbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        """Stop the probe thread, abandoning the probes in progress."""
+        if self.thread is None:
+            return
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self._cancel)
+        self.thread.join()
+        self.thread = None
@@ -22,10 +22,9 @@
 """AFS CellServDB parser"""
 
 import sys, logging, re
-import dns.resolver
 import six
 from collections import OrderedDict
-from pprint import pformat
+from contextlib import contextmanager
 
 try:
     from urllib.request import urlopen # python3
@@ -34,21 +33,82 @@ except ImportError:
 
 log = logging.getLogger('avdb')
 
-def readfile(path):
-    """Read a CellServDB file from a url or local path."""
+CELL_RE = re.compile(r'>(\S+)\s*(?:#(.*))?$')
+HOST_RE = re.compile(r'(\d+\.\d+\.\d+\.\d+)\s+#(.*)$')
+
+def _ascii(text):
+    """Flatten a string to ascii; non-ascii characters are escaped."""
+    try:
+        text.encode('ascii')
+        return text
+    except UnicodeError:
+        return text.encode('ascii', 'backslashreplace').decode('ascii')
+
+@contextmanager
+def openfile(path):
+    """Open a CellServDB file from a url, local path, or '-' for stdin.
+
+    Yields an iterable of lines, which may be bytes.
+    """
     if path.startswith('https://') or path.startswith('http://'):
-        response = urlopen(path)
-        text = response.read()
+        f = urlopen(path)
     elif path == '-':
-        text = sys.stdin.read()
+        f = None
     else:
         if path.startswith('file://'):
             path = path.replace('file://', '')
-        with open(path, 'r') as f:
-            text = f.read()
+        f = open(path, 'rb')
+    try:
+        yield sys.stdin if f is None else f
+    finally:
+        if f is not None:
+            f.close()
+
+def readfile(path):
+    """Read a CellServDB file from a url or local path."""
+    with openfile(path) as f:
+        text = f.read()
     text = six.ensure_text(text, encoding='utf-8', errors='replace')
     return text
 
+def iterparse(lines):
+    """Parse CellServDB lines as they are read.
+
+    Yields (cellname, desc, hosts) for each cell, where hosts is a list of
+    (address, hostname) tuples. Lines may be text or bytes, so a file or url
+    may be parsed without reading it all first.
+
+    with csdb.openfile('/tmp/CellServDB') as f:
+        for name,desc,hosts in csdb.iterparse(f):
+            print(name, hosts)
+    """
+    cell_match = CELL_RE.match
+    host_match = HOST_RE.match
+    name = None
+    desc = ''
+    hosts = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.strip()
+        if not line:
+            continue
+        c = line[0]
+        if c == '>':
+            m = cell_match(line)
+            if m:
+                if name:
+                    yield (name, desc, hosts)
+                name = m.group(1)
+                desc = _ascii((m.group(2) or '').strip())
+                hosts = []
+        elif c.isdigit():
+            m = host_match(line)
+            if m:
+                hosts.append((m.group(1), m.group(2).strip()))
+    if name:
+        yield (name, desc, hosts)
+
 def parse(text):
     """Parse CellServDB text into a dictionary.
 
@@ -61,27 +121,7 @@ def parse(text):
                  ('207.89.43.110', 'afsdb5.sinenomine.net')]})]
     """
     cells = OrderedDict()
-    name = None
-    desc = ''
-    hosts = []
-    for line in text.splitlines():
-        m = re.match('\S*$', line)
-        if m:
-            continue # skip blanks
-        m = re.match('>(\S+)\s+#(.*)\s*$', line)
-        if m:
-            if name:
-                cells[name] = {'desc':desc, 'hosts':hosts}
-            name = m.group(1)
-            desc = pformat(m.group(2)).strip("'") # Flatten descriptions to ascii.
-            hosts = []
-            continue # start of entry
-        m = re.match('(\d+\.\d+\.\d+\.\d+)\s+#(.*)\s*$', line)
-        if m:
-            hostaddr = m.group(1)
-            hostname = m.group(2)
-            hosts.append((hostaddr, hostname))
-    if name:
+    for name,desc,hosts in iterparse(text.splitlines()):
         cells[name] = {'desc':desc, 'hosts':hosts}
     return cells
 
@@ -90,43 +130,9 @@ def lookup(name):
 
     Returns addresses for both AFSDB and SRV records.
     """
-    hostnames = set()
+    from avdb.resolver import Resolver
+    resolver = Resolver()
     try:
-        answers = dns.resolver.query(name, 'AFSDB')
-        for rdata in answers:
-            hostname = rdata.get_hostname().to_text().strip('.')
-            hostnames.add(hostname)
-    except Exception as e:
-        log.warning("DNS query failed: %s", e)
-
-    services = (
-        'afs3-vlserver', # servers providing AFS VLDB services.
-        'afs3-prserver', # servers providing AFS PTS services.
-    )
-    proto = 'udp'
-    for service in services:
-        # The label of a DNS SRV record, as defined in RFC 5864.
-        label = '_{service}._{proto}.{name}' \
-                .format(service=service, proto=proto, name=name)
-        try:
-            answers = dns.resolver.query(label, 'SRV')
-            for rdata in answers:
-                hostname = rdata.target.to_text().strip('.')
-                hostnames.add(hostname)
-        except Exception as e:
-            log.warning("DNS query failed: %s", e)
-
-    results = []
-    for hostname in hostnames:
-        addrs = []
-        try:
-            answers = dns.resolver.query(hostname, 'A')
-            for rdata in answers:
-                addr = rdata.to_text().encode('utf-8') # unicode to str
-                addrs.append(addr)
-        except Exception as e:
-            log.warning("DNS query failed: %s", e)
-        if addrs:
-            results.append((addrs[0], hostname))
-
-    return results
+        return resolver.lookup(name)
+    finally:
+        resolver.close()
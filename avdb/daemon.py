@@ -0,0 +1,208 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Continuous scan scheduler
+
+Each node has its own next-due time, kept in a priority queue. Probes are
+spread evenly over time, up to a fixed rate. Nodes which keep reporting the
+same version, or which do not reply, are probed less and less often, up to
+a maximum interval. Nodes whose version just changed are checked again soon.
+
+The probes run on a single long-lived avdb.aio.Prober thread. Due nodes are
+handed to it as the rate allows, while the results of earlier probes are
+taken as they arrive, so a slow or dead host does not hold back the others.
+"""
+
+import heapq, logging, random, time
+from sqlalchemy import select
+from avdb.model import Host, Node, NodeCurrent, VersionString
+from avdb.ingest import Ingest
+from avdb.metrics import metrics
+
+log = logging.getLogger('avdb')
+
+class Scheduler(object):
+    """Probe nodes continuously with adaptive per-node intervals."""
+
+    def __init__(self, session, prober, min_interval=3600, max_interval=7*86400,
+                 backoff=2.0, rate=10.0, refresh=600, batch_size=1000, rtt=None,
+                 flush_interval=60):
+        self.session = session
+        self.prober = prober
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.rate = max(0.001, rate)
+        self.refresh = refresh
+        self.ingest = Ingest(session, batch_size=batch_size, rtt=rtt)
+        self.flush_interval = flush_interval
+        self.flushed = time.time() # when no results were waiting to be saved
+        self.queue = [] # (due, node_id)
+        self.nodes = {} # node_id -> [address, port, version, interval, due, down]
+        self.inflight = 0
+        self.loaded = 0
+        self.credit = 0.0 # probes allowed by the rate limit
+        self.last = None
+        self.metrics_file = None
+        self.metrics_format = 'prometheus'
+        self.metrics_interval = 60
+        self.metrics_written = 0
+        self.metrics_probes = 0
+
+    def export_metrics(self, path, format='prometheus', interval=60):
+        """Write the metrics to a file periodically."""
+        self.metrics_file = path
+        self.metrics_format = format
+        self.metrics_interval = interval
+
+    def _push(self, node_id, due):
+        self.nodes[node_id][4] = due
+        heapq.heappush(self.queue, (due, node_id))
+
+    def load(self):
+        """Update the schedule from the database.
+
+        New active nodes are given random first due times over the minimum
+        interval, so the initial probes are spread out instead of sent in one
+        burst. Nodes which were removed, or deactivated by the operator, are
+        dropped. Nodes the scheduler itself found unreachable are kept, with
+        their backed-off intervals, so they are noticed when they return.
+        Nodes deactivated because they stopped replying, such as those found
+        unreachable before a restart, are scheduled at the maximum interval.
+        """
+        node = Node.__table__
+        host = Host.__table__
+        current = NodeCurrent.__table__
+        string = VersionString.__table__
+        query = select([node.c.id, host.c.address, node.c.port, node.c.active,
+                        node.c.down, string.c.raw]) \
+                .select_from(node.join(host, node.c.host_id == host.c.id)
+                             .outerjoin(current, current.c.node_id == node.c.id)
+                             .outerjoin(string, string.c.id == current.c.string_id))
+        now = time.time()
+        seen = set()
+        added = 0
+        for node_id,address,port,active,down,version in self.session.execute(query):
+            seen.add(node_id)
+            state = self.nodes.get(node_id)
+            if state is None and active:
+                self.nodes[node_id] = [address, port, version, self.min_interval, 0, False]
+                self._push(node_id, now + random.uniform(0, self.min_interval))
+                added += 1
+            elif state is None and down:
+                self.nodes[node_id] = [address, port, version, self.max_interval, 0, True]
+                self._push(node_id, now + random.uniform(0, self.max_interval))
+                added += 1
+            elif state is not None and not active and not down:
+                del self.nodes[node_id]
+        for node_id in list(self.nodes.keys()):
+            if node_id not in seen:
+                del self.nodes[node_id]
+        self.session.commit()
+        self.loaded = now
+        log.info("scheduled %d new nodes; %d nodes total", added, len(self.nodes))
+
+    def due(self, now, limit):
+        """Pop up to limit nodes which are due."""
+        targets = []
+        while self.queue and self.queue[0][0] <= now and len(targets) < limit:
+            due,node_id = heapq.heappop(self.queue)
+            state = self.nodes.get(node_id)
+            if state is None or state[4] != due:
+                continue # Dropped or rescheduled.
+            targets.append((node_id, state[0], state[1]))
+        return targets
+
+    def reschedule(self, node_id, version, now):
+        """Pick the next due time of a node from its probe result."""
+        state = self.nodes.get(node_id)
+        if state is None:
+            return
+        previous,interval = state[2],state[3]
+        if version and version != previous:
+            if previous:
+                log.info("node %s:%s changed version", state[0], state[1])
+            interval = self.min_interval
+        else:
+            interval = min(interval * self.backoff, self.max_interval)
+        if version:
+            state[2] = version
+        state[3] = interval
+        state[5] = not version
+        self._push(node_id, now + interval * random.uniform(0.9, 1.1))
+
+    def step(self, wait=1.0):
+        """Probe the nodes which are due, within the rate limit.
+
+        The due nodes are handed to the running prober, then the results
+        which arrive within the wait are taken. They are saved in batches of
+        batch_size, or when the oldest has waited for the flush interval.
+        """
+        now = time.time()
+        if now - self.loaded >= self.refresh:
+            self.load()
+        if self.last is not None:
+            self.credit = min(self.credit + self.rate * (now - self.last), max(1.0, self.rate))
+        self.last = now
+        targets = self.due(now, int(self.credit))
+        self.credit -= len(targets)
+        for target in targets:
+            self.prober.put(target)
+        self.inflight += len(targets)
+        result = self.prober.get(timeout=wait)
+        while result is not None:
+            node_id,address,port,version = result
+            self.inflight -= 1
+            self.ingest.add(node_id, version)
+            self.reschedule(node_id, version, time.time())
+            result = self.prober.get(timeout=0) if self.inflight else None
+        if self.ingest.pending and now - self.flushed >= self.flush_interval:
+            self.ingest.flush()
+        if not self.ingest.pending:
+            self.flushed = now
+        if self.metrics_file and now - self.metrics_written >= self.metrics_interval:
+            self.write_metrics(now)
+        return len(targets)
+
+    def write_metrics(self, now):
+        probes = metrics.get('probes')
+        if self.metrics_written:
+            elapsed = now - self.metrics_written
+            metrics.set('nodes_per_second', (probes - self.metrics_probes) / elapsed)
+        metrics.set('scheduled_nodes', len(self.nodes))
+        metrics.write(self.metrics_file, self.metrics_format)
+        self.metrics_written = now
+        self.metrics_probes = probes
+
+    def run(self, tick=1.0):
+        """Run until interrupted."""
+        # Wake often enough to send the probes one or a few at a time.
+        wait = min(tick, 1.0 / self.rate)
+        self.load()
+        self.prober.start()
+        try:
+            while True:
+                self.step(wait)
+        except KeyboardInterrupt:
+            log.warning("interrupted")
+        finally:
+            self.prober.stop()
+            self.ingest.flush()
@@ -0,0 +1,206 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Bulk import of cells, hosts and nodes"""
+
+import logging
+from collections import OrderedDict
+from sqlalchemy import bindparam, select
+from avdb.model import Cell, Host, Node, NodeCurrent, chunks
+
+log = logging.getLogger('avdb')
+
+# The database server nodes scanned on each host.
+NODES = (
+    ('ptserver', 7002),
+    ('vlserver', 7003),
+)
+
+class Importer(object):
+    """Add cells, hosts and nodes to the database in bulk.
+
+    The existing cell names, host addresses and node keys are loaded once,
+    so adding a known cell or host costs a dictionary lookup instead of a
+    query. New rows are written with bulk inserts when commit() is called.
+    A known host given in another cell is moved to that cell, and nodes
+    which were deactivated because no source listed their host are made
+    active again.
+
+    importer = Importer(session)
+    importer.add_host('example.com', '192.0.2.1', 'afsdb1.example.com')
+    importer.commit()
+    """
+
+    def __init__(self, session):
+        self.session = session
+        cell = Cell.__table__
+        host = Host.__table__
+        node = Node.__table__
+        self.cells = dict(session.execute(select([cell.c.name, cell.c.id])).fetchall())
+        self.hosts = {}      # address -> id
+        self.host_cells = {} # address -> cell id
+        query = select([host.c.address, host.c.id, host.c.cell_id])
+        for address,host_id,cell_id in session.execute(query).fetchall():
+            self.hosts[address] = host_id
+            self.host_cells[address] = cell_id
+        query = select([node.c.host_id, node.c.name])
+        self.nodes = set((host_id, name) for host_id,name in session.execute(query))
+        query = select([host.c.address]).distinct() \
+                .select_from(host.join(node, node.c.host_id == host.c.id)) \
+                .where(node.c.unlisted == 1)
+        self.unlisted = set(row[0] for row in session.execute(query)) # addresses
+        self.new_cells = OrderedDict() # name -> desc
+        self.new_hosts = OrderedDict() # address -> (cellname, hostname)
+        self.touched = set()           # addresses needing nodes
+        self.moved = OrderedDict()     # old address -> new address
+        self.recelled = OrderedDict()  # address -> new cellname
+        self.activate = set()          # unlisted addresses listed again
+        self.changed = set()           # ids of hosts whose node state is stale
+
+    def add_cell(self, name, desc=''):
+        """Add a cell unless it already exists."""
+        if name not in self.cells and name not in self.new_cells:
+            self.new_cells[name] = desc
+
+    def add_host(self, cellname, address, hostname=''):
+        """Add a host and its nodes unless they already exist.
+
+        A known host is moved to the cell if it was in another one, and its
+        nodes deactivated for not being listed are made active again.
+        """
+        self.add_cell(cellname)
+        if address in self.hosts:
+            if self.host_cells.get(address) != self.cells.get(cellname):
+                self.recelled[address] = cellname
+            if address in self.unlisted:
+                self.activate.add(address)
+        elif address not in self.new_hosts:
+            self.new_hosts[address] = (cellname, hostname)
+        self.touched.add(address)
+
+    def move_host(self, old, new):
+        """Change the address of a known host, keeping its nodes and history.
+
+        Returns False, and changes nothing, if the old address is unknown or
+        the new one is already taken.
+        """
+        if old not in self.hosts or new in self.hosts or new in self.new_hosts:
+            return False
+        self.moved[old] = new
+        self.hosts[new] = self.hosts.pop(old)
+        self.host_cells[new] = self.host_cells.pop(old)
+        self.recelled.pop(old, None)
+        self.activate.discard(old)
+        self.touched.discard(old)
+        if old in self.unlisted:
+            self.unlisted.discard(old)
+            self.unlisted.add(new)
+        return True
+
+    def commit(self):
+        """Write the new rows in a single transaction."""
+        ncells = self._insert_cells()
+        self._update_hosts()
+        nhosts = self._insert_hosts()
+        nnodes = self._insert_nodes()
+        nactive = self._activate()
+        NodeCurrent.refresh(self.session, self.changed)
+        self.changed.clear()
+        self.session.commit()
+        if ncells or nhosts or nnodes:
+            log.info("imported %d cells, %d hosts, %d nodes", ncells, nhosts, nnodes)
+        if nactive:
+            log.info("activated %d nodes", nactive)
+        return (ncells, nhosts, nnodes)
+
+    def _insert_cells(self):
+        table = Cell.__table__
+        names = list(self.new_cells.keys())
+        if not names:
+            return 0
+        rows = [{'name':n, 'desc':d or ''} for n,d in self.new_cells.items()]
+        self.session.execute(table.insert(), rows)
+        for chunk in chunks(names):
+            query = select([table.c.name, table.c.id]).where(table.c.name.in_(chunk))
+            self.cells.update(self.session.execute(query).fetchall())
+        self.new_cells.clear()
+        return len(rows)
+
+    def _update_hosts(self):
+        table = Host.__table__
+        if self.moved:
+            rows = [{'old':old, 'new':new} for old,new in self.moved.items()]
+            for old,new in self.moved.items():
+                log.info("host %s moved to %s", old, new)
+                self.changed.add(self.hosts[new])
+            self.session.execute(table.update()
+                                 .where(table.c.address == bindparam('old'))
+                                 .values(address=bindparam('new')), rows)
+            self.moved.clear()
+        if self.recelled:
+            rows = []
+            for address,cellname in self.recelled.items():
+                log.info("host %s moved to cell %s", address, cellname)
+                self.changed.add(self.hosts[address])
+                self.host_cells[address] = self.cells[cellname]
+                rows.append({'addr':address, 'cid':self.cells[cellname]})
+            self.session.execute(table.update()
+                                 .where(table.c.address == bindparam('addr'))
+                                 .values(cell_id=bindparam('cid')), rows)
+            self.recelled.clear()
+
+    def _activate(self):
+        count = Node.set_listed(self.session, True, self.activate)
+        self.unlisted -= self.activate
+        self.activate.clear()
+        return count
+
+    def _insert_hosts(self):
+        table = Host.__table__
+        addresses = list(self.new_hosts.keys())
+        if not addresses:
+            return 0
+        rows = []
+        for address,(cellname,hostname) in self.new_hosts.items():
+            rows.append({'cell_id':self.cells[cellname], 'address':address, 'name':hostname})
+        self.session.execute(table.insert(), rows)
+        for chunk in chunks(addresses):
+            query = select([table.c.address, table.c.id]).where(table.c.address.in_(chunk))
+            self.hosts.update(self.session.execute(query).fetchall())
+        for address,(cellname,_) in self.new_hosts.items():
+            self.host_cells[address] = self.cells[cellname]
+        self.new_hosts.clear()
+        return len(rows)
+
+    def _insert_nodes(self):
+        table = Node.__table__
+        rows = []
+        for address in self.touched:
+            host_id = self.hosts[address]
+            for name,port in NODES:
+                if (host_id, name) not in self.nodes:
+                    rows.append({'host_id':host_id, 'name':name, 'port':port})
+                    self.nodes.add((host_id, name))
+                    self.changed.add(host_id)
+        if rows:
+            self.session.execute(table.insert(), rows)
+        self.touched.clear()
+        return len(rows)
@@ -0,0 +1,215 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Batched scan result ingestion"""
+
+import datetime, logging
+from sqlalchemy import select, and_, bindparam
+from avdb.model import Node, NodeCurrent, Observation, Version, VersionString, chunks, insert_ignore
+from avdb.metrics import metrics
+
+log = logging.getLogger('avdb')
+
+class Ingest(object):
+    """Buffer scan results and apply them to the database in batches.
+
+    Each batch looks up the ids of the version strings, adding new strings
+    to the version_string table, inserts the newly seen (node, version) pairs,
+    extends or opens the observation ranges, updates the node active flags
+    and the node_current table with set-based updates, and is committed.
+    A node is deactivated, and its observation range closed, when it has not
+    replied to two probes in a row, so a single lost packet does not
+    deactivate it. The round trip time estimates of the rtt estimator, if
+    given, are saved with each batch.
+    """
+
+    def __init__(self, session, batch_size=1000, rtt=None):
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self.rtt = rtt
+        self.versions = [] # (node_id, version) pairs
+        self.up = []       # node ids which replied
+        self.down = []     # node ids which did not reply
+        self.pending = 0
+        self.strings = {}  # version string to version_string id
+
+    def add(self, node_id, version):
+        """Add a scan result; a version of None means the node did not reply."""
+        metrics.inc('probes')
+        if version:
+            metrics.inc('probe_replies')
+            self.versions.append((node_id, version))
+            self.up.append(node_id)
+        else:
+            metrics.inc('probe_failures')
+            self.down.append(node_id)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered results and commit."""
+        if self.pending == 0:
+            return
+        session = self.session
+        # One local time for the whole batch, like the other times avdb
+        # records, rather than the database clock, which may differ.
+        now = datetime.datetime.now()
+        with metrics.timer('db_batch_seconds'):
+            ids = VersionString.ids(session, set(v for _,v in self.versions), self.strings)
+            versions = [(node_id, ids[v]) for node_id,v in self.versions]
+            added = self._add_versions(versions, now)
+            down = self._failed_again(self.down)
+            opened = self._observe(versions, down, now)
+            activated = self._set_active(self.up, True)
+            deactivated = self._set_active(down, False)
+            self._set_probed(self.up, 'ok', now)
+            self._set_probed(self.down, 'noreply', now)
+            self._update_current(versions, down, opened, now)
+            if self.rtt is not None:
+                self.rtt.save(session)
+            session.commit()
+        metrics.inc('db_batches')
+        log.info("saved %d results: %d new versions, %d nodes activated, "
+                 "%d nodes deactivated", self.pending, added, activated, deactivated)
+        self.versions = []
+        self.up = []
+        self.down = []
+        self.pending = 0
+
+    def _add_versions(self, versions, now):
+        table = Version.__table__
+        new = set(versions)
+        node_ids = list(set(node_id for node_id,_ in new))
+        for chunk in chunks(node_ids):
+            query = select([table.c.node_id, table.c.string_id]) \
+                    .where(table.c.node_id.in_(chunk))
+            for node_id,string_id in self.session.execute(query):
+                new.discard((node_id, string_id))
+        if new:
+            rows = [{'node_id':n, 'string_id':v, 'added':now} for n,v in sorted(new)]
+            self.session.execute(insert_ignore(self.session, table), rows)
+        return len(new)
+
+    def _observe(self, versions, down, now):
+        """Extend or open the observation ranges; returns the nodes with new ranges."""
+        table = Observation.__table__
+        session = self.session
+        latest = dict(versions)
+        down = set(down) - set(latest)
+        node_ids = sorted(set(latest) | down)
+        opened = {} # node_id -> (observation id, string_id)
+        close = []
+        for chunk in chunks(node_ids):
+            query = select([table.c.node_id, table.c.id, table.c.string_id]) \
+                    .where(and_(table.c.node_id.in_(chunk), table.c.open == 1)) \
+                    .order_by(table.c.id)
+            for node_id,id_,string_id in session.execute(query):
+                if node_id in opened:
+                    close.append(opened[node_id][0]) # keep only the newest open
+                opened[node_id] = (id_, string_id)
+        extend = []
+        new = []
+        for node_id,string_id in latest.items():
+            current = opened.get(node_id)
+            if current is not None and current[1] == string_id:
+                extend.append(current[0])
+            else:
+                if current is not None:
+                    close.append(current[0])
+                new.append({'node_id':node_id, 'string_id':string_id})
+        close.extend(opened[n][0] for n in down if n in opened)
+        for chunk in chunks(sorted(extend)):
+            session.execute(table.update().where(table.c.id.in_(chunk))
+                            .values(last_seen=now, probe_count=table.c.probe_count + 1))
+        for chunk in chunks(sorted(close)):
+            session.execute(table.update().where(table.c.id.in_(chunk)).values(open=0))
+        if new:
+            insert = table.insert().values(first_seen=now, last_seen=now,
+                                           probe_count=1, open=1)
+            session.execute(insert, new)
+        return set(row['node_id'] for row in new)
+
+    def _failed_again(self, node_ids):
+        """Select the nodes which did not reply to their previous probe either."""
+        table = Node.__table__
+        failed = []
+        for chunk in chunks(sorted(set(node_ids))):
+            query = select([table.c.id]) \
+                    .where(and_(table.c.id.in_(chunk), table.c.last_status == 'noreply'))
+            failed.extend(row[0] for row in self.session.execute(query))
+        return failed
+
+    def _set_active(self, node_ids, active):
+        # Reactivate only the nodes deactivated for not replying, never
+        # those the operator deactivated.
+        table = Node.__table__
+        criteria = table.c.active == int(not active)
+        if active:
+            criteria = and_(criteria, table.c.down == 1)
+        count = 0
+        for chunk in chunks(sorted(set(node_ids))):
+            update = table.update() \
+                .where(and_(table.c.id.in_(chunk), criteria)) \
+                .values(active=int(active), down=int(not active))
+            count += self.session.execute(update).rowcount
+        return count
+
+    def _set_probed(self, node_ids, status, now):
+        table = Node.__table__
+        for chunk in chunks(sorted(set(node_ids))):
+            update = table.update().where(table.c.id.in_(chunk)) \
+                .values(last_probe=now, last_status=status)
+            self.session.execute(update)
+
+    def _update_current(self, versions, down, opened, now):
+        table = NodeCurrent.__table__
+        session = self.session
+        latest = dict(versions)
+        node_ids = sorted(set(self.up) | set(self.down))
+        current = {}
+        for chunk in chunks(node_ids):
+            query = select([table.c.node_id, table.c.string_id]).where(table.c.node_id.in_(chunk))
+            current.update(session.execute(query).fetchall())
+        missing = [n for n in node_ids if n not in current]
+        for chunk in chunks(missing):
+            session.execute(table.insert().from_select(NodeCurrent.columns,
+                                                       NodeCurrent.source(chunk)))
+            query = select([table.c.node_id, table.c.string_id]).where(table.c.node_id.in_(chunk))
+            current.update(session.execute(query).fetchall())
+        seen = []
+        changed = []
+        for node_id,string_id in latest.items():
+            if current.get(node_id) == string_id and node_id not in opened:
+                seen.append(node_id)
+            else:
+                changed.append({'b_node_id':node_id, 'b_string_id':string_id})
+        for chunk in chunks(sorted(seen)):
+            session.execute(table.update().where(table.c.node_id.in_(chunk))
+                            .values(active=1, last_seen=now))
+        if changed:
+            update = table.update().where(table.c.node_id == bindparam('b_node_id')) \
+                .values(string_id=bindparam('b_string_id'), active=1,
+                        first_seen=now, last_seen=now)
+            session.execute(update, changed)
+        for chunk in chunks(sorted(set(down))):
+            session.execute(table.update().where(table.c.node_id.in_(chunk))
+                            .values(active=0))
@@ -0,0 +1,121 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Database-backed work leases for distributed scans
+
+Scan workers on several machines share one database. Each worker claims a
+batch of stale nodes by writing its name and an expiry time to the lease
+table, probes them, saves the results, and claims the next batch. A batch
+claimed by a worker which crashed is claimed again by another worker after
+the lease expires.
+
+On MySQL, batches are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so
+workers do not wait on each other. Other databases claim with a single
+conditional UPDATE, which sqlite runs atomically.
+"""
+
+import datetime, itertools, logging, os, socket
+from sqlalchemy import select, and_, or_
+from avdb.model import Cell, Host, Lease, Node, insert_ignore
+
+log = logging.getLogger('avdb')
+
+def default_worker():
+    """Name this worker after the host and process."""
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+class Leases(object):
+    """Claim batches of stale nodes to probe."""
+
+    def __init__(self, session, cutoff, worker=None, size=500, ttl=300):
+        self.session = session
+        self.cutoff = cutoff
+        self.worker = worker or default_worker()
+        self.size = max(1, size)
+        self.ttl = ttl
+        self.counter = itertools.count(1)
+        self.token = None
+
+    def populate(self):
+        """Add lease rows for nodes which do not have one yet."""
+        lease = Lease.__table__
+        node = Node.__table__
+        missing = select([node.c.id]) \
+                .select_from(node.outerjoin(lease, lease.c.node_id == node.c.id)) \
+                .where(lease.c.node_id == None)
+        self.session.execute(insert_ignore(self.session, lease)
+                             .from_select(['node_id'], missing))
+        self.session.commit()
+
+    def _eligible(self, now):
+        lease = Lease.__table__
+        node = Node.__table__
+        return and_(node.c.active == 1,
+                    or_(node.c.last_probe == None, node.c.last_probe < self.cutoff),
+                    or_(lease.c.expires == None, lease.c.expires < now))
+
+    def claim(self):
+        """Claim a batch of nodes; returns (node_id, address, port, cell name) tuples."""
+        lease = Lease.__table__
+        node = Node.__table__
+        host = Host.__table__
+        cell = Cell.__table__
+        session = self.session
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=self.ttl)
+        self.token = '{0}:{1}'.format(self.worker, next(self.counter))
+        candidates = select([lease.c.node_id]) \
+                .select_from(lease.join(node, node.c.id == lease.c.node_id)) \
+                .where(self._eligible(now)) \
+                .order_by(node.c.last_probe) \
+                .limit(self.size)
+        if session.get_bind().dialect.name == 'mysql':
+            rows = session.execute(candidates.with_for_update(skip_locked=True)).fetchall()
+            ids = [row[0] for row in rows]
+            if ids:
+                session.execute(lease.update().where(lease.c.node_id.in_(ids))
+                                .values(owner=self.token, expires=expires))
+        else:
+            # The subquery is re-evaluated inside the UPDATE, so a batch
+            # claimed by another worker in the meantime is not claimed again.
+            session.execute(lease.update()
+                            .where(lease.c.node_id.in_(candidates))
+                            .values(owner=self.token, expires=expires))
+        session.commit()
+        query = select([node.c.id, host.c.address, node.c.port, cell.c.name]) \
+                .select_from(lease.join(node, node.c.id == lease.c.node_id)
+                             .join(host, host.c.id == node.c.host_id)
+                             .join(cell, cell.c.id == host.c.cell_id)) \
+                .where(lease.c.owner == self.token)
+        targets = [tuple(row) for row in session.execute(query)]
+        session.commit()
+        log.info("worker %s claimed %d nodes", self.worker, len(targets))
+        return targets
+
+    def release(self):
+        """Release the nodes of the last claimed batch."""
+        if self.token is None:
+            return
+        lease = Lease.__table__
+        self.session.execute(lease.update().where(lease.c.owner == self.token)
+                             .values(owner=None, expires=None))
+        self.session.commit()
+        self.token = None
@@ -0,0 +1,206 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Scan counters and latency histograms
+
+The scan stages record into the shared metrics object:
+
+    from avdb.metrics import metrics
+    metrics.inc('probes')
+    with metrics.timer('db_batch_seconds'):
+        ...
+
+The metrics may be written as a Prometheus text file, for the node exporter
+textfile collector, or as a JSON summary.
+"""
+
+import bisect, json, logging, os, threading, time
+
+log = logging.getLogger('avdb')
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'dns_queries': "DNS queries sent",
+    'dns_cache_hits': "DNS lookups answered from the cache or by a query in progress",
+    'dns_errors': "DNS queries which failed",
+    'dns_query_seconds': "DNS query latency",
+    'probes': "Nodes probed",
+    'probe_replies': "Nodes which replied to the version probe",
+    'probe_failures': "Nodes which did not reply to the version probe",
+    'probe_timeouts': "Probe attempts which timed out",
+    'probe_retries': "Probe attempts after the first",
+    'probe_rtt_seconds': "Version probe round trip time",
+    'db_batches': "Result batches written to the database",
+    'db_batch_seconds': "Time to write a result batch",
+    'dns_seconds': "Duration of the DNS stage of the last scan",
+    'probe_seconds': "Duration of the probe stage of the last scan",
+    'nodes_per_second': "Nodes probed per second",
+    'scheduled_nodes': "Nodes in the daemon schedule",
+}
+
+class Histogram(object):
+    """Cumulative latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of its bucket.
+
+        Returns None if there are no values, or the quantile is above the
+        last bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound,count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+class Metrics(object):
+    """Named counters, gauges and histograms."""
+
+    def __init__(self, prefix='avdb'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name):
+        """Context manager observing the elapsed time of a block."""
+        return _Timer(self, name)
+
+    def get(self, name):
+        """Get the value of a counter or gauge."""
+        return self.counters.get(name, self.gauges.get(name, 0))
+
+    def to_prometheus(self):
+        """Format the metrics in the Prometheus text exposition format."""
+        lines = []
+        def header(name, kind, suffix=''):
+            full = '{0}_{1}{2}'.format(self.prefix, name, suffix)
+            if name in HELP:
+                lines.append('# HELP {0} {1}'.format(full, HELP[name]))
+            lines.append('# TYPE {0} {1}'.format(full, kind))
+            return full
+        with self.lock:
+            for name in sorted(self.counters):
+                full = header(name, 'counter', '_total')
+                lines.append('{0} {1}'.format(full, self.counters[name]))
+            for name in sorted(self.gauges):
+                full = header(name, 'gauge')
+                lines.append('{0} {1}'.format(full, self.gauges[name]))
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                full = header(name, 'histogram')
+                total = 0
+                for bound,count in zip(histogram.buckets, histogram.counts):
+                    total += count
+                    lines.append('{0}_bucket{{le="{1}"}} {2}'.format(full, bound, total))
+                lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(full, histogram.count))
+                lines.append('{0}_sum {1}'.format(full, histogram.sum))
+                lines.append('{0}_count {1}'.format(full, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """Summarize the metrics as a JSON document."""
+        with self.lock:
+            summary = {
+                'elapsed': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {},
+            }
+            for name,histogram in self.histograms.items():
+                mean = histogram.sum / histogram.count if histogram.count else None
+                summary['histograms'][name] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'mean': mean,
+                    'p50': histogram.quantile(0.50),
+                    'p90': histogram.quantile(0.90),
+                    'p99': histogram.quantile(0.99),
+                }
+        return json.dumps(summary, indent=2, sort_keys=True) + '\n'
+
+    def write(self, path, format='prometheus'):
+        """Write the metrics to a file, replacing it atomically."""
+        if format == 'json':
+            text = self.to_json()
+        else:
+            text = self.to_prometheus()
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, path)
+        log.info("wrote metrics to %s", path)
+
+class _Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        self.metrics.observe(self.name, self.elapsed)
+        return False
+
+# The metrics of this process.
+metrics = Metrics()
@@ -21,14 +21,19 @@
 
 """AFS version database model"""
 
-import os
-from sqlalchemy import create_engine, Column, DateTime, String, Integer, ForeignKey
+import datetime, os, logging, ipaddress
+from sqlalchemy import create_engine, Column, DateTime, Float, String, Integer, ForeignKey, Index, \
+    MetaData, Table, sql
+from sqlalchemy import select, inspect, and_, or_, bindparam
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import mysql
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.sql import func
 from pprint import pformat
 
+log = logging.getLogger('avdb')
+
 engine = None
 Base = declarative_base()
 Session = sessionmaker()
@@ -42,6 +47,34 @@ def mysql_create_db(admin, password, dbuser, dbpasswd, dbhost, dbname):
     db.execute("GRANT ALL PRIVILEGES ON {dbname}.* TO '{dbuser}'@'localhost' WITH GRANT OPTION".format(**locals()))
     db.execute("FLUSH PRIVILEGES")
 
+def flatten(text):
+    """Flatten a string to ascii."""
+    return pformat(text).strip("'")
+
+def chunks(items, size=500):
+    """Split a list of values into chunks small enough for an IN clause."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def insert_ignore(session, table):
+    """Insert statement which skips rows that violate a unique constraint."""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    elif dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    else:
+        return table.insert()
+
+def glob_match(column, pattern):
+    """SQL condition to match a column against a shell-style glob pattern."""
+    if '*' not in pattern and '?' not in pattern:
+        return column == pattern
+    like = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    like = like.replace('*', '%').replace('?', '_')
+    return column.like(like, escape='\\')
+
 def init_db(url=None):
     global engine
     if engine is None:
@@ -49,14 +82,19 @@ def init_db(url=None):
             url = 'sqlite:///{}'.format(os.path.expanduser('~/avdb.db'))
         engine = create_engine(url)
         Session.configure(bind=engine)
+        fresh = 'cell' not in inspect(engine).get_table_names()
         Base.metadata.create_all(engine)
+        if fresh:
+            stamp(engine)
+        else:
+            migrate(engine)
 
 class Cell(Base):
     __tablename__ = 'cell'
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True)
     desc = Column(String(255), default='')
-    added = Column(DateTime, default=func.now())
+    added = Column(DateTime, default=datetime.datetime.now)
     hosts = relationship('Host', backref='cell')
 
     def __repr__(self):
@@ -82,10 +120,14 @@ class Cell(Base):
 class Host(Base):
     __tablename__ = 'host'
     id = Column(Integer, primary_key=True)
-    cell_id = Column(Integer, ForeignKey('cell.id'))
+    cell_id = Column(Integer, ForeignKey('cell.id'), index=True)
     name = Column(String(255))
     address = Column(String(255), unique=True)
-    added = Column(DateTime, default=func.now())
+    added = Column(DateTime, default=datetime.datetime.now)
+    srtt = Column(Float)                     # smoothed probe round trip time
+    rttvar = Column(Float)                   # round trip time variation
+    loss = Column(Float)                     # fraction of probe requests lost
+    failures = Column(Integer, default=0)    # probes without a reply in a row
     nodes = relationship('Node', backref='host')
 
     def __repr__(self):
@@ -95,6 +137,9 @@ class Host(Base):
             "name='{self.name}', " \
             "address='{self.address}', " \
             "added={self.added}, " \
+            "srtt={self.srtt}, " \
+            "loss={self.loss}, " \
+            "failures={self.failures})>" \
             .format(self=self)
 
     @staticmethod
@@ -109,11 +154,15 @@ class Node(Base):
     __tablename__ = 'node'
     __table_args__ = (UniqueConstraint('name', 'host_id'),)
     id = Column(Integer, primary_key=True)
-    host_id = Column(Integer, ForeignKey('host.id'))
+    host_id = Column(Integer, ForeignKey('host.id'), index=True)
     name = Column(String(255))
     port = Column(Integer, default=0)
-    active = Column(Integer, default=1)
-    added = Column(DateTime, default=func.now())
+    active = Column(Integer, default=1, index=True)
+    added = Column(DateTime, default=datetime.datetime.now)
+    last_probe = Column(DateTime, index=True) # when the node was last probed
+    last_status = Column(String(16))          # result of the last probe
+    unlisted = Column(Integer, default=0)     # 1 if deactivated as no source lists it
+    down = Column(Integer, default=0)         # 1 if deactivated as it stopped replying
     versions = relationship('Version', backref='node')
 
     def __repr__(self):
@@ -122,12 +171,143 @@ class Node(Base):
             "host_id={self.host_id}, " \
             "name='{self.name}', " \
             "active={self.active}, " \
-            "added={self.added})>" \
+            "added={self.added}, " \
+            "last_probe={self.last_probe}, " \
+            "last_status={self.last_status}, " \
+            "unlisted={self.unlisted}, " \
+            "down={self.down})>" \
             .format(self=self)
 
     def cellname(self):
         return self.host.cell.name
 
+    @staticmethod
+    def host_ids(session, cells=None, hosts=None):
+        """Generate selects of the ids of hosts matching cell globs and addresses.
+
+        The hosts may be given as addresses or subnets in CIDR notation. The
+        addresses, and the ids of the hosts found in the subnets, are given
+        in chunks, one select each. Raises ValueError for an invalid subnet.
+        """
+        cell = Cell.__table__
+        host = Host.__table__
+        criteria = []
+        if cells:
+            names = or_(*[glob_match(cell.c.name, c) for c in cells])
+            criteria.append(host.c.cell_id.in_(select([cell.c.id]).where(names)))
+        if not hosts:
+            yield select([host.c.id]).where(and_(*criteria))
+            return
+        addresses = [h for h in hosts if '/' not in h]
+        subnets = [ipaddress.ip_network(u'%s' % h, strict=False) for h in hosts if '/' in h]
+        ids = []
+        if subnets:
+            query = select([host.c.id, host.c.address]).where(and_(*criteria))
+            for host_id,address in session.execute(query).fetchall():
+                try:
+                    address = ipaddress.ip_address(u'%s' % address)
+                except ValueError:
+                    continue
+                if any(address in subnet for subnet in subnets):
+                    ids.append(host_id)
+        for chunk in chunks(addresses):
+            yield select([host.c.id]).where(and_(host.c.address.in_(chunk), *criteria))
+        for chunk in chunks(ids):
+            yield select([host.c.id]).where(host.c.id.in_(chunk))
+
+    @staticmethod
+    def set_active(session, active, cells=None, hosts=None):
+        """Set the active flag of the nodes on the matching hosts.
+
+        The nodes are no longer taken to have been deactivated for not being
+        listed or not replying, so later imports and scans leave them as set.
+        Returns the number of nodes changed. Raises ValueError for an invalid
+        subnet.
+        """
+        node = Node.__table__
+        current = NodeCurrent.__table__
+        update = node.update().values(active=int(active), unlisted=0, down=0) \
+                .where(or_(node.c.active != int(active), node.c.unlisted == 1,
+                           node.c.down == 1))
+        update_current = current.update().values(active=int(active)) \
+                .where(current.c.active != int(active))
+        if not (cells or hosts):
+            count = session.execute(update).rowcount
+            session.execute(update_current)
+            return count
+        count = 0
+        for host_ids in Node.host_ids(session, cells, hosts):
+            count += session.execute(update.where(node.c.host_id.in_(host_ids))).rowcount
+            node_ids = select([node.c.id]).where(node.c.host_id.in_(host_ids))
+            session.execute(update_current.where(current.c.node_id.in_(node_ids)))
+        return count
+
+    @staticmethod
+    def set_listed(session, listed, addresses):
+        """Deactivate the nodes of hosts which no source lists, or reactivate them.
+
+        Only active nodes are deactivated, and they are marked as unlisted;
+        only the nodes so marked are reactivated when their hosts are listed
+        again, so nodes deactivated by the operator stay inactive. Returns
+        the number of nodes changed.
+        """
+        host = Host.__table__
+        node = Node.__table__
+        current = NodeCurrent.__table__
+        if listed:
+            criteria = node.c.unlisted == 1
+            values = {'active':1, 'unlisted':0}
+        else:
+            criteria = node.c.active == 1
+            values = {'active':0, 'unlisted':1}
+        count = 0
+        for chunk in chunks(sorted(set(addresses))):
+            host_ids = select([host.c.id]).where(host.c.address.in_(chunk))
+            where = and_(node.c.host_id.in_(host_ids), criteria)
+            node_ids = select([node.c.id]).where(where)
+            session.execute(current.update().where(current.c.node_id.in_(node_ids))
+                            .values(active=values['active']))
+            count += session.execute(node.update().where(where).values(**values)).rowcount
+        return count
+
+    @staticmethod
+    def targets(session, cells=None, cellnames=None, cutoff=None, chunk_size=1000):
+        """Generate the (node_id, address, port, cell name) of the active nodes to probe.
+
+        The nodes are selected in the cells matching name globs or in the
+        named cells, and only those not probed since the cutoff, if given.
+        They are read in chunks in node id order; each chunk is read in full,
+        so no query is left open while the caller works on the targets.
+        """
+        cell = Cell.__table__
+        host = Host.__table__
+        node = Node.__table__
+        # Not active == 1, which would lead sqlite to walk the active index
+        # instead of looking up the named cells.
+        criteria = [node.c.active != 0]
+        if cellnames is not None:
+            criteria.append(cell.c.name.in_(cellnames))
+        elif cells:
+            criteria.append(or_(*[glob_match(cell.c.name, c) for c in cells]))
+        if cutoff:
+            criteria.append(or_(node.c.last_probe == None, node.c.last_probe < cutoff))
+        query = select([node.c.id, host.c.address, node.c.port, cell.c.name]) \
+                .select_from(node.join(host, host.c.id == node.c.host_id)
+                             .join(cell, cell.c.id == host.c.cell_id)) \
+                .order_by(node.c.id) \
+                .limit(chunk_size)
+        last = None
+        while True:
+            chunk = query.where(and_(*criteria))
+            if last is not None:
+                chunk = chunk.where(node.c.id > last)
+            rows = session.execute(chunk).fetchall()
+            for row in rows:
+                yield tuple(row)
+            if len(rows) < chunk_size:
+                break
+            last = rows[-1][0]
+
     @staticmethod
     def add(session, host, name, **kwargs):
         node = session.query(Node).filter_by(host=host, name=name).first()
@@ -136,33 +316,583 @@ class Node(Base):
             session.add(node)
         return node
 
+class VersionString(Base):
+    """A distinct version string, stored once and referenced by id."""
+    __tablename__ = 'version_string'
+    id = Column(Integer, primary_key=True)
+    # As reported by the server, and compared byte for byte on mysql, where
+    # the default collation ignores case.
+    raw = Column(String(255).with_variant(mysql.VARCHAR(255, binary=True), 'mysql'),
+                 unique=True)
+    text = Column(String(1024))            # flattened to ascii
+
+    def __repr__(self):
+        return "<VersionString(" \
+            "id={self.id}, " \
+            "raw='{self.raw}', " \
+            "text='{self.text}')>" \
+            .format(self=self)
+
+    @staticmethod
+    def ids(session, versions, cache=None):
+        """Get the ids of version strings, adding the new ones.
+
+        Returns a dictionary of version string to id. The cache dictionary,
+        if given, is used and updated to save queries for known strings.
+        Strings which the database collation takes to be equal to a stored
+        one, such as with trailing spaces on mysql, are given its id.
+        """
+        table = VersionString.__table__
+        ids = {}
+        missing = set()
+        for version in versions:
+            if cache is not None and version in cache:
+                ids[version] = cache[version]
+            else:
+                missing.add(version)
+        if missing:
+            def lookup():
+                for chunk in chunks(sorted(missing)):
+                    query = select([table.c.raw, table.c.id]).where(table.c.raw.in_(chunk))
+                    for raw,id_ in session.execute(query):
+                        ids[raw] = id_
+                        missing.discard(raw)
+            lookup()
+            if missing:
+                rows = [{'raw':v, 'text':flatten(v)} for v in sorted(missing)]
+                session.execute(insert_ignore(session, table), rows)
+                lookup()
+            # The database returned the stored string, not the one asked for.
+            for version in sorted(missing):
+                query = select([table.c.id]).where(table.c.raw == version)
+                ids[version] = session.execute(query).scalar()
+            if cache is not None:
+                cache.update(ids)
+        return ids
+
 class Version(Base):
     __tablename__ = 'version'
+    __table_args__ = (Index('ux_version_node_id_string_id', 'node_id', 'string_id', unique=True),)
     id = Column(Integer, primary_key=True)
     node_id = Column(Integer, ForeignKey('node.id'))
-    _version = Column('version', String(255))
-    added = Column(DateTime, default=func.now())
+    string_id = Column(Integer, ForeignKey('version_string.id'), index=True)
+    added = Column(DateTime, default=datetime.datetime.now)
+    string = relationship('VersionString')
 
     @property
     def version(self):
-        return pformat(self._version).strip("'") # flatten to ascii
-
-    @version.setter
-    def version(self, version):
-        self._version = version
+        return self.string.text if self.string else None
 
     def __repr__(self):
         return "<Version(" \
             "id={self.id}, " \
             "node_id={self.node_id}, " \
-            "version='{self.version}', " \
+            "string_id={self.string_id}, " \
             "added={self.added})>" \
             .format(self=self)
 
     @staticmethod
     def add(session, node, version, **kwargs):
-        version_ = session.query(Version).filter_by(node=node, version=version).first()
+        string_id = VersionString.ids(session, [version])[version]
+        version_ = session.query(Version).filter_by(node=node, string_id=string_id).first()
         if version_ is None:
-            version_ = Version(node=node, version=version, **kwargs)
+            version_ = Version(node=node, string_id=string_id, **kwargs)
             session.add(version_)
         return version_
+
+class Observation(Base):
+    """Range of time over which a node was seen running a version.
+
+    Each probe which finds the same version extends the open range of the
+    node. The range is closed when the node does not reply to two probes in
+    a row or its version changes, and the next reply opens a new range.
+    """
+    __tablename__ = 'observation'
+    __table_args__ = (Index('ix_observation_node_id_open', 'node_id', 'open'),
+                      Index('ix_observation_first_seen_last_seen', 'first_seen', 'last_seen'))
+    id = Column(Integer, primary_key=True)
+    node_id = Column(Integer, ForeignKey('node.id'))
+    string_id = Column(Integer, ForeignKey('version_string.id'), index=True)
+    first_seen = Column(DateTime)
+    last_seen = Column(DateTime)
+    probe_count = Column(Integer, default=1)
+    open = Column(Integer, default=1) # 1 while the range may be extended
+    string = relationship('VersionString')
+
+    def __repr__(self):
+        return "<Observation(" \
+            "id={self.id}, " \
+            "node_id={self.node_id}, " \
+            "string_id={self.string_id}, " \
+            "first_seen={self.first_seen}, " \
+            "last_seen={self.last_seen}, " \
+            "probe_count={self.probe_count}, " \
+            "open={self.open})>" \
+            .format(self=self)
+
+    @staticmethod
+    def at(when):
+        """Condition to select the ranges which include a time."""
+        table = Observation.__table__
+        return and_(table.c.first_seen <= when, table.c.last_seen >= when)
+
+class NodeCurrent(Base):
+    """Denormalized current state of each node, maintained by imports and scans."""
+    __tablename__ = 'node_current'
+    __table_args__ = (Index('ix_node_current_cell_address', 'cell', 'address'),)
+    node_id = Column(Integer, ForeignKey('node.id'), primary_key=True)
+    cell = Column(String(255))
+    address = Column(String(255))
+    name = Column(String(255))
+    port = Column(Integer, default=0)
+    active = Column(Integer, default=1)
+    string_id = Column(Integer, ForeignKey('version_string.id'), index=True)
+    first_seen = Column(DateTime) # when the current version was first seen
+    last_seen = Column(DateTime)  # when the current version was last seen
+
+    def __repr__(self):
+        return "<NodeCurrent(" \
+            "node_id={self.node_id}, " \
+            "cell='{self.cell}', " \
+            "address='{self.address}', " \
+            "name='{self.name}', " \
+            "port={self.port}, " \
+            "active={self.active}, " \
+            "string_id={self.string_id}, " \
+            "first_seen={self.first_seen}, " \
+            "last_seen={self.last_seen})>" \
+            .format(self=self)
+
+    columns = ('node_id', 'cell', 'address', 'name', 'port', 'active',
+               'string_id', 'first_seen', 'last_seen')
+
+    @staticmethod
+    def source(node_ids=None):
+        """Select the current state of nodes from the normalized tables.
+
+        The current version of a node is that of its newest observation
+        range, which is open while the node keeps replying with it. Nodes
+        without observations, as in databases being upgraded, get their
+        newest version, and nodes never probed are given no version.
+        """
+        cell = Cell.__table__
+        host = Host.__table__
+        node = Node.__table__
+        version = Version.__table__
+        observation = Observation.__table__
+        latest = select([observation.c.node_id, func.max(observation.c.id).label('id')]) \
+                .group_by(observation.c.node_id).alias('latest')
+        newest = select([version.c.node_id, func.max(version.c.id).label('id')]) \
+                .group_by(version.c.node_id).alias('newest')
+        joined = node.join(host, node.c.host_id == host.c.id) \
+                .join(cell, host.c.cell_id == cell.c.id) \
+                .outerjoin(latest, latest.c.node_id == node.c.id) \
+                .outerjoin(observation, observation.c.id == latest.c.id) \
+                .outerjoin(newest, newest.c.node_id == node.c.id) \
+                .outerjoin(version, version.c.id == newest.c.id)
+        query = select([node.c.id.label('node_id'),
+                        cell.c.name.label('cell'),
+                        host.c.address,
+                        node.c.name,
+                        node.c.port,
+                        node.c.active,
+                        func.coalesce(observation.c.string_id, version.c.string_id),
+                        func.coalesce(observation.c.first_seen, version.c.added),
+                        func.coalesce(observation.c.last_seen, version.c.added)]) \
+                .select_from(joined)
+        if node_ids is not None:
+            query = query.where(node.c.id.in_(node_ids))
+        return query
+
+    @staticmethod
+    def rebuild(bind):
+        """Recreate the current state of all nodes from the version history."""
+        table = NodeCurrent.__table__
+        bind.execute(table.delete())
+        bind.execute(table.insert().from_select(NodeCurrent.columns, NodeCurrent.source()))
+
+    @staticmethod
+    def refresh(bind, host_ids):
+        """Recreate the current state of the nodes of some hosts.
+
+        Used when hosts are added, or change address or cell, so the
+        denormalized cell and address follow the hosts.
+        """
+        table = NodeCurrent.__table__
+        node = Node.__table__
+        for chunk in chunks(sorted(set(host_ids))):
+            node_ids = select([node.c.id]).where(node.c.host_id.in_(chunk))
+            bind.execute(table.delete().where(table.c.node_id.in_(node_ids)))
+            bind.execute(table.insert().from_select(NodeCurrent.columns,
+                                                    NodeCurrent.source(node_ids)))
+
+class Lease(Base):
+    """Claim on a node by a distributed scan worker."""
+    __tablename__ = 'lease'
+    node_id = Column(Integer, ForeignKey('node.id'), primary_key=True)
+    owner = Column(String(255), index=True)
+    expires = Column(DateTime, index=True)
+
+    def __repr__(self):
+        return "<Lease(" \
+            "node_id={self.node_id}, " \
+            "owner='{self.owner}', " \
+            "expires={self.expires})>" \
+            .format(self=self)
+
+class ScanRun(Base):
+    """Progress of a scan, so an interrupted scan may be resumed."""
+    __tablename__ = 'scan_run'
+    id = Column(Integer, primary_key=True)
+    started = Column(DateTime)
+    finished = Column(DateTime, index=True)
+    stage = Column(String(16), default='dns') # dns, probe, done
+    cutoff = Column(DateTime)                # probe nodes last probed before this
+    cells = Column(String(4096), default='')  # space separated cell patterns
+    probed = Column(Integer, default=0)
+    replies = Column(Integer)
+    failures = Column(Integer)
+    dns_seconds = Column(Float)
+    probe_seconds = Column(Float)
+    nodes_per_second = Column(Float)
+    options = Column(String(4096), default='') # probe options, as json
+    worker = Column(String(255))               # lease worker, if not a whole scan
+
+    @staticmethod
+    def unfinished(session):
+        """Get the most recent unfinished run of a whole scan, or None."""
+        return session.query(ScanRun) \
+                      .filter(ScanRun.finished == None, ScanRun.worker == None) \
+                      .order_by(ScanRun.id.desc()).first()
+
+    def probe_counts(self, session):
+        """Count the nodes probed since this run started, by probe status."""
+        node = Node.__table__
+        query = select([node.c.last_status, func.count()]) \
+                .where(node.c.last_probe >= self.started) \
+                .group_by(node.c.last_status)
+        return dict(session.execute(query).fetchall())
+
+    def __repr__(self):
+        return "<ScanRun(" \
+            "id={self.id}, " \
+            "started={self.started}, " \
+            "finished={self.finished}, " \
+            "stage='{self.stage}', " \
+            "cutoff={self.cutoff}, " \
+            "cells='{self.cells}', " \
+            "probed={self.probed}, " \
+            "replies={self.replies}, " \
+            "failures={self.failures}, " \
+            "dns_seconds={self.dns_seconds}, " \
+            "probe_seconds={self.probe_seconds}, " \
+            "nodes_per_second={self.nodes_per_second}, " \
+            "options='{self.options}', " \
+            "worker='{self.worker}')>" \
+            .format(self=self)
+
+class DnsCache(Base):
+    __tablename__ = 'dns_cache'
+    __table_args__ = (UniqueConstraint('name', 'rdtype'),)
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255))
+    rdtype = Column(String(16))
+    data = Column(String(4096), default='')
+    expires = Column(Integer, default=0)
+
+    def __repr__(self):
+        return "<DnsCache(" \
+            "id={self.id}, " \
+            "name='{self.name}', " \
+            "rdtype='{self.rdtype}', " \
+            "data='{self.data}', " \
+            "expires={self.expires})>" \
+            .format(self=self)
+
+class Source(Base):
+    """A CellServDB source, and the hash of its content when last imported."""
+    __tablename__ = 'source'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(1024))
+    digest = Column(String(64), default='')
+    imported = Column(DateTime)
+
+    def __repr__(self):
+        return "<Source(" \
+            "id={self.id}, " \
+            "name='{self.name}', " \
+            "digest='{self.digest}', " \
+            "imported={self.imported})>" \
+            .format(self=self)
+
+class SourceCell(Base):
+    """A cell listed in a source when it was last imported."""
+    __tablename__ = 'source_cell'
+    id = Column(Integer, primary_key=True)
+    source_id = Column(Integer, ForeignKey('source.id'), index=True)
+    name = Column(String(255))
+    desc = Column(String(255), default='')
+
+    def __repr__(self):
+        return "<SourceCell(" \
+            "id={self.id}, " \
+            "source_id={self.source_id}, " \
+            "name='{self.name}', " \
+            "desc='{self.desc}')>" \
+            .format(self=self)
+
+class SourceHost(Base):
+    """A host listed in a source when it was last imported."""
+    __tablename__ = 'source_host'
+    id = Column(Integer, primary_key=True)
+    source_id = Column(Integer, ForeignKey('source.id'), index=True)
+    cell = Column(String(255))
+    address = Column(String(255), index=True)
+    name = Column(String(255), default='')
+
+    def __repr__(self):
+        return "<SourceHost(" \
+            "id={self.id}, " \
+            "source_id={self.source_id}, " \
+            "cell='{self.cell}', " \
+            "address='{self.address}', " \
+            "name='{self.name}')>" \
+            .format(self=self)
+
+#------------------------------------------------------------------------------
+# Schema migrations
+#
+# New tables are created by create_all(), but existing tables are never
+# altered by it. Changes to existing tables are made by the migration
+# functions below, which are run in order by init_db() on databases created
+# by an older avdb. Append new migrations to the end of the list.
+#
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+    applied = Column(DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<SchemaVersion(" \
+            "id={self.id}, " \
+            "version={self.version}, " \
+            "applied={self.applied})>" \
+            .format(self=self)
+
+def _create_missing_indexes(bind, table, names):
+    """Create the named indexes declared on a table which are not in the database."""
+    existing = set(ix['name'] for ix in inspect(bind).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            log.info("Creating index %s on table %s", index.name, table.name)
+            index.create(bind)
+
+def _add_column(bind, table, column):
+    """Add a column declared on a table which is not in the database."""
+    existing = set(c['name'] for c in inspect(bind).get_columns(table.name))
+    if column.name not in existing:
+        log.info("Adding column %s to table %s", column.name, table.name)
+        coltype = column.type.compile(dialect=bind.dialect)
+        bind.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table.name, column.name, coltype))
+
+# The version table before the version strings were moved out of it.
+_version_v1 = Table('version', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('node_id', Integer),
+    Column('version', String(255)),
+    Column('added', DateTime),
+    Index('ux_version_node_id_version', 'node_id', 'version', unique=True))
+
+def _migrate_1(bind):
+    """Add indexes for the scan, report and list queries."""
+    table = _version_v1
+    query = select([func.min(table.c.id)]).group_by(table.c.node_id, table.c.version)
+    keep = set(row[0] for row in bind.execute(query))
+    dups = [row[0] for row in bind.execute(select([table.c.id])) if row[0] not in keep]
+    for chunk in chunks(dups):
+        bind.execute(table.delete().where(table.c.id.in_(chunk)))
+    _create_missing_indexes(bind, Host.__table__, ['ix_host_cell_id'])
+    _create_missing_indexes(bind, Node.__table__, ['ix_node_host_id', 'ix_node_active'])
+    _create_missing_indexes(bind, _version_v1, ['ux_version_node_id_version'])
+
+def _migrate_2(bind):
+    """Track the time and result of the last probe of each node."""
+    table = Node.__table__
+    _add_column(bind, table, table.c.last_probe)
+    _add_column(bind, table, table.c.last_status)
+    _create_missing_indexes(bind, table, ['ix_node_last_probe'])
+
+def _migrate_3(bind):
+    """Keep the scan statistics in the scan run history."""
+    table = ScanRun.__table__
+    for name in ('replies', 'failures', 'dns_seconds', 'probe_seconds', 'nodes_per_second'):
+        _add_column(bind, table, table.c[name])
+
+def _migrate_4(bind):
+    """Move the version strings to the version_string table."""
+    old = _version_v1
+    table = Version.__table__
+    strings = VersionString.__table__
+    _add_column(bind, table, table.c.string_id)
+    # The strings are matched here rather than in SQL, since on mysql the
+    # old column compares case insensitively, and strings which differ only
+    # in case would be given the same id.
+    query = select([old.c.id, old.c.version]).where(old.c.version != None)
+    versions = bind.execute(query).fetchall()
+    existing = set(row[0] for row in bind.execute(select([strings.c.raw])))
+    rows = [{'raw':raw, 'text':flatten(raw)}
+            for raw in sorted(set(raw for _,raw in versions) - existing)]
+    if rows:
+        insert = strings.insert()
+        if bind.dialect.name == 'mysql':
+            insert = insert.prefix_with('IGNORE') # trailing spaces compare equal
+        bind.execute(insert, rows)
+    ids = dict(bind.execute(select([strings.c.raw, strings.c.id])).fetchall())
+    for raw in sorted(set(raw for _,raw in versions) - set(ids)):
+        ids[raw] = bind.execute(select([strings.c.id]).where(strings.c.raw == raw)).scalar()
+    # Both the old and new columns exist until the old one is dropped.
+    version = sql.table('version', sql.column('id'), sql.column('version'),
+                        sql.column('string_id'))
+    update = version.update().where(version.c.id == bindparam('b_id')) \
+            .values(string_id=bindparam('b_string_id'))
+    for chunk in chunks(versions, 1000):
+        bind.execute(update, [{'b_id':id_, 'b_string_id':ids[raw]} for id_,raw in chunk])
+    existing = set(ix['name'] for ix in inspect(bind).get_indexes('version'))
+    for index in old.indexes:
+        if index.name in existing:
+            log.info("Dropping index %s on table %s", index.name, old.name)
+            index.drop(bind)
+    _create_missing_indexes(bind, table, ['ux_version_node_id_string_id', 'ix_version_string_id'])
+    dialect = bind.dialect
+    if dialect.name == 'mysql' or \
+       (dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 35, 0)):
+        bind.execute("ALTER TABLE version DROP COLUMN version")
+    else:
+        bind.execute(version.update().values(version=None))
+    # The node current state is derived, so it is rebuilt in the new form.
+    current = NodeCurrent.__table__
+    current.drop(bind, checkfirst=True)
+    current.create(bind)
+    NodeCurrent.rebuild(bind)
+
+def _latest(*times):
+    """Get the latest of the times which are known."""
+    known = [t for t in times if t is not None]
+    return max(known) if known else None
+
+def _migrate_5(bind):
+    """Keep the observation ranges of each node and version."""
+    table = Observation.__table__
+    if bind.execute(select([func.count()]).select_from(table)).scalar() > 0:
+        return
+    # Only the first sighting of each version is known, so each version is
+    # taken to have run until the next one was first seen. Only the latest
+    # range of a node is open, and extended to the current state.
+    version = Version.__table__
+    current = NodeCurrent.__table__
+    query = select([current.c.node_id, current.c.string_id, current.c.first_seen,
+                    current.c.last_seen, current.c.active])
+    latest = dict((row[0], row[1:]) for row in bind.execute(query))
+    query = select([version.c.node_id]).where(version.c.string_id != None).distinct()
+    node_ids = sorted(row[0] for row in bind.execute(query))
+    for chunk in chunks(node_ids):
+        query = select([version.c.node_id, version.c.string_id, version.c.added]) \
+                .where(and_(version.c.node_id.in_(chunk), version.c.string_id != None)) \
+                .order_by(version.c.node_id, version.c.added, version.c.id)
+        seen = {} # node_id -> [(string_id, added)]
+        for node_id,string_id,added in bind.execute(query):
+            seen.setdefault(node_id, []).append((string_id, added))
+        rows = []
+        for node_id in chunk:
+            ranges = []
+            for string_id,added in seen[node_id]:
+                if ranges:
+                    ranges[-1]['last_seen'] = added
+                ranges.append({'node_id':node_id, 'string_id':string_id, 'first_seen':added,
+                               'last_seen':added, 'probe_count':1, 'open':0})
+            string_id,first_seen,last_seen,active = latest.get(node_id, (None,)*4)
+            if string_id is not None and string_id != ranges[-1]['string_id']:
+                # An older version seen again since the newest was first seen.
+                first_seen = _latest(first_seen or last_seen, ranges[-1]['first_seen'])
+                ranges[-1]['last_seen'] = first_seen
+                ranges.append({'node_id':node_id, 'string_id':string_id,
+                               'first_seen':first_seen, 'last_seen':first_seen,
+                               'probe_count':1, 'open':0})
+            if string_id is not None:
+                ranges[-1]['last_seen'] = _latest(last_seen, ranges[-1]['first_seen'])
+                ranges[-1]['open'] = active or 0
+            rows.extend(ranges)
+        bind.execute(table.insert(), rows)
+
+def _migrate_6(bind):
+    """Keep the probe round trip time and loss estimates of each host."""
+    table = Host.__table__
+    for name in ('srtt', 'rttvar', 'loss', 'failures'):
+        _add_column(bind, table, table.c[name])
+
+def _migrate_7(bind):
+    """Keep the probe options and lease worker of each scan run."""
+    table = ScanRun.__table__
+    for name in ('options', 'worker'):
+        _add_column(bind, table, table.c[name])
+
+def _migrate_8(bind):
+    """Compare version strings byte for byte on mysql."""
+    if bind.dialect.name == 'mysql':
+        bind.execute("ALTER TABLE version_string MODIFY raw VARCHAR(255) BINARY")
+
+def _migrate_9(bind):
+    """Mark the nodes deactivated because no source lists their hosts."""
+    table = Node.__table__
+    _add_column(bind, table, table.c.unlisted)
+
+def _migrate_10(bind):
+    """Mark the nodes deactivated because they stopped replying."""
+    table = Node.__table__
+    _add_column(bind, table, table.c.down)
+
+migrations = [
+    _migrate_1,
+    _migrate_2,
+    _migrate_3,
+    _migrate_4,
+    _migrate_5,
+    _migrate_6,
+    _migrate_7,
+    _migrate_8,
+    _migrate_9,
+    _migrate_10,
+]
+
+def schema_version(bind):
+    """Get the schema version of the database."""
+    table = SchemaVersion.__table__
+    version = bind.execute(select([func.max(table.c.version)])).scalar()
+    return version or 0
+
+def stamp(bind, version=None):
+    """Record the database schema version."""
+    if version is None:
+        version = len(migrations)
+    bind.execute(SchemaVersion.__table__.insert(), version=version)
+
+def migrate(engine):
+    """Bring the database schema up to date."""
+    current = schema_version(engine)
+    for version,migration in enumerate(migrations, start=1):
+        if version > current:
+            log.warning("Upgrading database schema to version %d: %s",
+                        version, migration.__doc__)
+            with engine.begin() as connection:
+                migration(connection)
+                stamp(connection, version)
+    # The node_current table is new to databases created before it existed.
+    current = NodeCurrent.__table__
+    node = Node.__table__
+    if engine.execute(select([func.count()]).select_from(current)).scalar() == 0 and \
+       engine.execute(select([func.count()]).select_from(node)).scalar() > 0:
+        log.warning("Building the node current state table")
+        with engine.begin() as connection:
+            NodeCurrent.rebuild(connection)
@@ -0,0 +1,319 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Streaming scan pipeline
+
+Cells are looked up in DNS while the nodes of the cells already looked up
+are being probed. As each batch of lookups completes, the hosts found are
+imported and the nodes of those cells are queued to be probed. The queues
+between the stages are bounded: the probers hold at most a window of
+targets, and DNS results wait in a bounded queue while the probers are busy.
+The targets are taken from the cells in turn, within the rate limits.
+
+Example:
+
+    discovery = Discovery(resolver, importer, nodes)
+    probes = ProcessProber(get_version, rtt, nprocs=10)
+    targets = interleave(discovery.targets(cellnames), limiter)
+    for node_id,address,port,version in stream(probes, targets):
+        print(address, port, version)
+
+where rtt is an avdb.rtt.Estimator, limiter an avdb.ratelimit.Limiter, and
+nodes is a function which generates the (node_id, address, port, cell)
+targets of a list of cell names. It should not keep a query open between
+targets, since the importer uses the same session while they are probed.
+"""
+
+import collections, logging, threading, time
+from avdb.metrics import metrics
+
+try:
+    import queue # python3
+except ImportError:
+    import Queue as queue # python2
+
+log = logging.getLogger('avdb')
+
+_END = object() # marks the end of the DNS results
+
+class ProcessProber(object):
+    """Probe nodes on a pool of processes; add targets with put().
+
+    The get_version function is given (node_id, address, port, timeouts)
+    tuples, with the timeout of each try of the host from the rtt estimator,
+    and returns (node_id, address, port, version, rtt, tries).
+    """
+
+    def __init__(self, get_version, rtt, nprocs=10):
+        self.get_version = get_version
+        self.rtt = rtt
+        self.nprocs = max(1, nprocs)
+        self.window = 4 * self.nprocs # targets queued by put()
+        self.pipe = None
+
+    def start(self):
+        import mpipe
+        stage = mpipe.UnorderedStage(self.get_version, self.nprocs)
+        self.pipe = mpipe.Pipeline(stage)
+        # mpipe can not wait for a result with a timeout, so the results
+        # are collected on a thread.
+        self.outbox = queue.Queue()
+        self.thread = threading.Thread(target=self._collect, name='avdb-results')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _collect(self):
+        for result in self.pipe.results():
+            self.outbox.put(result)
+
+    def put(self, target):
+        node_id,address,port = target
+        self.pipe.put((node_id, address, port, self.rtt.timeouts(address)))
+
+    def get(self, timeout=None):
+        """Get the next result, or None if none arrived within the timeout."""
+        try:
+            result = self.outbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        # The probes run in other processes, so their timings are
+        # returned with the results.
+        node_id,address,port,version,rtt,tries = result
+        if rtt is not None:
+            metrics.observe('probe_rtt_seconds', rtt)
+        if tries > 1:
+            metrics.inc('probe_retries', tries - 1)
+        self.rtt.observe(address, rtt, tries, version is not None or rtt is not None)
+        return (node_id, address, port, version)
+
+    def stop(self):
+        if self.pipe is not None:
+            self.pipe.put(None)
+            self.pipe = None
+
+def stream(prober, targets, wait=0.1):
+    """Probe the targets; yields the results as probes complete.
+
+    At most prober.window probes are queued at a time, and the next targets
+    are taken only when there is room for them. The targets iterable may
+    yield None when no target is ready yet, or the number of seconds until
+    one will be; the results of the probes in progress are taken meanwhile.
+    """
+    targets = iter(targets)
+    outstanding = 0
+    more = True
+    prober.start()
+    try:
+        while more or outstanding:
+            delay = None
+            while more and outstanding < prober.window:
+                try:
+                    target = next(targets)
+                except StopIteration:
+                    more = False
+                    break
+                if target is None or isinstance(target, float):
+                    delay = target
+                    break
+                prober.put(target)
+                outstanding += 1
+            if outstanding:
+                result = prober.get(timeout=(delay or wait) if more else None)
+                if result is not None:
+                    outstanding -= 1
+                    yield result
+            elif delay:
+                time.sleep(delay)
+    finally:
+        prober.stop()
+        if hasattr(targets, 'close'):
+            targets.close()
+
+def interleave(targets, limiter=None, lookahead=1000, wait=0.1):
+    """Take the targets of the cells in turn, within the rate limits.
+
+    The targets are (node_id, address, port, cell) tuples, or None when no
+    target is ready yet. Up to lookahead targets are read ahead and queued
+    by cell. Yields the (node_id, address, port) of the next target the
+    limiter allows, taking the cells in turn. When none is allowed yet, it
+    yields the seconds to wait instead of sleeping, so the caller may take
+    results meanwhile. Yields None when no target is queued or ready.
+    """
+    targets = iter(targets)
+    queues = {}                  # cell -> targets
+    turns = collections.deque()  # cells with queued targets
+    queued = 0
+    more = True
+    try:
+        while True:
+            while more and queued < lookahead:
+                try:
+                    target = next(targets)
+                except StopIteration:
+                    more = False
+                    break
+                if target is None:
+                    break
+                cell = target[3]
+                if cell not in queues:
+                    queues[cell] = collections.deque()
+                    turns.append(cell)
+                queues[cell].append(target)
+                queued += 1
+            if not queued:
+                if not more:
+                    return
+                yield None
+                continue
+            now = time.time()
+            delay = wait
+            for _ in range(len(turns)):
+                cell = turns[0]
+                turns.rotate(-1)
+                node_id,address,port,_ = queues[cell][0]
+                if limiter is not None:
+                    needed = limiter.delay(cell, address, now)
+                    if needed > 0:
+                        delay = min(delay, needed)
+                        continue
+                    limiter.take(cell, address, now)
+                queues[cell].popleft()
+                if not queues[cell]:
+                    del queues[cell]
+                    turns.pop()
+                queued -= 1
+                yield (node_id, address, port)
+                break
+            else:
+                yield float(delay)
+    finally:
+        if hasattr(targets, 'close'):
+            targets.close()
+
+class Discovery(object):
+    """Look up cells in DNS and import the hosts found, as a stream.
+
+    The lookups run on the resolver threads. Lookups which complete while
+    the nodes of earlier cells are still being probed wait in a bounded
+    queue, which holds back the lookups when it is full.
+    """
+
+    def __init__(self, resolver, importer, nodes=None, batch_size=100, queue_size=1000,
+                 sources=None):
+        self.resolver = resolver
+        self.importer = importer
+        self.sources = sources # records the hosts found as the dns source
+        self.nodes = nodes
+        self.batch_size = max(1, batch_size)
+        self.queue_size = max(1, queue_size)
+        self.seconds = None # time taken by the lookups, once all are imported;
+                            # stays None if the lookups failed
+        self.lookup_seconds = None # set by the lookup thread
+
+    def _put(self, results, item, stop):
+        """Wait for room in the queue, unless the consumer has stopped."""
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _lookup(self, cellnames, results, stop):
+        start = time.time()
+        try:
+            lookups = self.resolver.lookup_cells(cellnames)
+            try:
+                for result in lookups:
+                    if not self._put(results, result, stop):
+                        return
+            finally:
+                lookups.close()
+            self.lookup_seconds = time.time() - start
+        except Exception as e:
+            log.error("DNS lookups failed: %s", e)
+        finally:
+            self._put(results, _END, stop)
+
+    def _import(self, batch):
+        importer = self.importer
+        for cellname,cellinfo in batch:
+            for address,hostname in cellinfo:
+                log.info("importing cell %s host %s (%s) from dns", cellname, hostname, address)
+            if self.sources is not None:
+                self.sources.found(cellname, cellinfo)
+            else:
+                for address,hostname in cellinfo:
+                    importer.add_host(cellname, address, hostname)
+        importer.commit()
+
+    def targets(self, cellnames, wait=0.1):
+        """Look up the cells; yields the probe targets of each cell imported.
+
+        Yields None while waiting for lookups to complete.
+        """
+        results = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._lookup, args=(cellnames, results, stop),
+                                  name='avdb-dns')
+        thread.daemon = True
+        thread.start()
+        count = 0
+        done = False
+        try:
+            while not done:
+                batch = []
+                try:
+                    result = results.get(timeout=wait)
+                    while True:
+                        if result is _END:
+                            done = True
+                            break
+                        batch.append(result)
+                        if len(batch) >= self.batch_size:
+                            break
+                        result = results.get_nowait()
+                except queue.Empty:
+                    pass
+                if not batch:
+                    if not done:
+                        yield None
+                    continue
+                self._import(batch)
+                if count // 100 != (count + len(batch)) // 100:
+                    self.resolver.save()
+                count += len(batch)
+                if self.nodes is not None:
+                    for target in self.nodes([cellname for cellname,_ in batch]):
+                        yield target
+            self.resolver.save()
+            self.seconds = self.lookup_seconds
+            if self.seconds is not None:
+                log.info("dns lookups of %d cells done in %.1f seconds", count, self.seconds)
+        finally:
+            stop.set()
+            thread.join()
+
+    def run(self, cellnames):
+        """Look up and import the cells, without probing."""
+        for _ in self.targets(cellnames):
+            pass
@@ -0,0 +1,117 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+
+"""Token bucket probe rate limits
+
+Probes may be limited in all, to each cell, and to each subnet of the
+addresses probed. Each limit is a token bucket: a probe takes a token,
+and the tokens are refilled at the rate of the limit. The buckets of each
+cell and subnet hold a single token, so their probes are spread evenly
+over time instead of sent in bursts.
+
+Example:
+
+    limiter = Limiter(rate=1000, cell_rate=10, subnet_rate=10, prefix=24)
+    delay = limiter.delay(cellname, address)
+    if delay == 0:
+        limiter.take(cellname, address)
+"""
+
+import socket, struct, time
+
+class Bucket(object):
+    """A token bucket."""
+
+    def __init__(self, rate, size=1.0, now=None):
+        self.rate = float(rate)
+        self.size = max(1.0, size)
+        self.tokens = self.size
+        self.last = time.time() if now is None else now
+
+    def refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.size, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def delay(self, now):
+        """The time until a token is available."""
+        self.refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1.0
+
+def subnet(address, prefix=24):
+    """The subnet of an IPv4 address, as an integer; other addresses are their own subnet."""
+    try:
+        value = struct.unpack('!I', socket.inet_aton(address))[0]
+    except (socket.error, OSError, TypeError):
+        return address
+    return value >> (32 - max(0, min(32, prefix)))
+
+class Limiter(object):
+    """Probe rate limits in all, per cell and per subnet.
+
+    A rate of 0 or None is no limit.
+    """
+
+    def __init__(self, rate=None, cell_rate=None, subnet_rate=None, prefix=24):
+        self.rate = rate
+        self.cell_rate = cell_rate
+        self.subnet_rate = subnet_rate
+        self.prefix = prefix
+        # The total may be taken in bursts of a tenth of a second, which
+        # keeps the prober busy between the wake ups of the scheduler.
+        self.bucket = Bucket(rate, size=rate / 10.0) if rate else None
+        self.cells = {}   # cell name -> Bucket
+        self.subnets = {} # subnet -> Bucket
+
+    def _buckets(self, cell, address, now):
+        buckets = []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+        if self.cell_rate:
+            bucket = self.cells.get(cell)
+            if bucket is None:
+                bucket = self.cells[cell] = Bucket(self.cell_rate, now=now)
+            buckets.append(bucket)
+        if self.subnet_rate:
+            key = subnet(address, self.prefix)
+            bucket = self.subnets.get(key)
+            if bucket is None:
+                bucket = self.subnets[key] = Bucket(self.subnet_rate, now=now)
+            buckets.append(bucket)
+        return buckets
+
+    def delay(self, cell, address, now=None):
+        """The time until a probe of the address in the cell is allowed."""
+        now = time.time() if now is None else now
+        return max([b.delay(now) for b in self._buckets(cell, address, now)] or [0.0])
+
+    def take(self, cell, address, now=None):
+        """Count a probe of the address in the cell."""
+        now = time.time() if now is None else now
+        for bucket in self._buckets(cell, address, now):
+            bucket.take(now)
@@ -0,0 +1,212 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Concurrent, caching DNS lookups of AFS cell servers
+
+Queries for many cells run at the same time on a shared thread pool.
+Answers are cached until their TTL expires, and queries for the same name
+are made only once, even when several cells share a server. The cache may
+be saved in the avdb database so later scans skip unchanged lookups.
+
+Example:
+
+    resolver = Resolver(session)
+    for cellname,hosts in resolver.lookup_cells(['example.com']):
+        print(cellname, hosts)
+    resolver.save()
+"""
+
+import logging, threading, time
+import dns.resolver
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from sqlalchemy import select
+from avdb.model import DnsCache, chunks
+from avdb.metrics import metrics
+
+log = logging.getLogger('avdb')
+
+# The services of the DNS SRV records, as defined in RFC 5864.
+SERVICES = (
+    'afs3-vlserver', # servers providing AFS VLDB services.
+    'afs3-prserver', # servers providing AFS PTS services.
+)
+
+class Resolver(object):
+    """Look up the database servers of AFS cells."""
+
+    def __init__(self, session=None, nprocs=10, nameservers=None, port=53,
+                 timeout=5.0, negative_ttl=300):
+        if nameservers:
+            self.resolver = dns.resolver.Resolver(configure=False)
+            self.resolver.nameservers = list(nameservers)
+            self.resolver.port = port
+        else:
+            self.resolver = dns.resolver.Resolver()
+        self.resolver.lifetime = timeout
+        self.session = session
+        self.nprocs = max(1, nprocs)
+        self.negative_ttl = negative_ttl
+        self.pool = ThreadPoolExecutor(self.nprocs)
+        self.lock = threading.Lock()
+        self.cache = {}    # (name, rdtype) -> (expires, values)
+        self.inflight = {} # (name, rdtype) -> future
+        self.dirty = set() # keys to be saved
+        self.hits = 0
+        self.misses = 0
+        if session is not None:
+            self.load()
+
+    def load(self):
+        """Load the unexpired cache entries from the database."""
+        table = DnsCache.__table__
+        now = int(time.time())
+        query = select([table.c.name, table.c.rdtype, table.c.data, table.c.expires]) \
+                .where(table.c.expires > now)
+        for name,rdtype,data,expires in self.session.execute(query):
+            values = data.split() if data else []
+            self.cache[(name, rdtype)] = (expires, values)
+
+    def save(self):
+        """Save the cache entries fetched since the last save."""
+        if self.session is None or not self.dirty:
+            return
+        table = DnsCache.__table__
+        with self.lock:
+            keys = list(self.dirty)
+            self.dirty.clear()
+            rows = []
+            for name,rdtype in keys:
+                expires,values = self.cache[(name, rdtype)]
+                rows.append({'name':name, 'rdtype':rdtype,
+                             'data':' '.join(values), 'expires':expires})
+        for rdtype in set(rdtype for _,rdtype in keys):
+            names = [n for n,t in keys if t == rdtype]
+            for chunk in chunks(names):
+                self.session.execute(table.delete().where(
+                    (table.c.rdtype == rdtype) & table.c.name.in_(chunk)))
+        self.session.execute(table.insert(), rows)
+        self.session.commit()
+        log.info("saved %d dns cache entries", len(rows))
+
+    def _resolve(self, name, rdtype):
+        """Run a DNS query; returns (expires, values) or None on error."""
+        resolve = getattr(self.resolver, 'resolve', None) or self.resolver.query
+        metrics.inc('dns_queries')
+        try:
+            with metrics.timer('dns_query_seconds'):
+                answers = resolve(name, rdtype)
+            values = []
+            for rdata in answers:
+                if rdtype == 'AFSDB':
+                    values.append(rdata.hostname.to_text().strip('.'))
+                elif rdtype == 'SRV':
+                    values.append(rdata.target.to_text().strip('.'))
+                else:
+                    values.append(rdata.to_text())
+            return (int(answers.expiration), values)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+            log.warning("DNS query failed: %s", e)
+            return (int(time.time()) + self.negative_ttl, [])
+        except Exception as e:
+            log.warning("DNS query failed: %s", e)
+            metrics.inc('dns_errors')
+            return None
+
+    def _fetch(self, key):
+        name,rdtype = key
+        try:
+            result = self._resolve(name, rdtype)
+        finally:
+            with self.lock:
+                del self.inflight[key] # so the next query tries again
+        if result is None:
+            return []
+        with self.lock:
+            self.cache[key] = result
+            self.dirty.add(key)
+        return result[1]
+
+    def query(self, name, rdtype):
+        """Get the values of a DNS record, from the cache when possible.
+
+        Returns a future. Concurrent queries for the same name share a future.
+        """
+        key = (name, rdtype)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                metrics.inc('dns_cache_hits')
+                future = Future()
+                future.set_result(entry[1])
+            elif key in self.inflight:
+                self.hits += 1
+                metrics.inc('dns_cache_hits')
+                future = self.inflight[key]
+            else:
+                self.misses += 1
+                future = self.inflight[key] = self.pool.submit(self._fetch, key)
+        return future
+
+    def lookup(self, cellname):
+        """Query DNS for cell hosts.
+
+        Returns (address, hostname) tuples for both AFSDB and SRV records.
+        """
+        queries = [self.query(cellname, 'AFSDB')]
+        for service in SERVICES:
+            label = '_{service}._udp.{name}'.format(service=service, name=cellname)
+            queries.append(self.query(label, 'SRV'))
+        hostnames = set()
+        for future in queries:
+            hostnames.update(future.result())
+        hostnames = sorted(hostnames)
+        addrs = [self.query(hostname, 'A') for hostname in hostnames]
+        results = []
+        for hostname,future in zip(hostnames, addrs):
+            values = future.result()
+            if values:
+                results.append((values[0], hostname))
+        return results
+
+    def lookup_cells(self, cellnames):
+        """Look up many cells at once; yields (cellname, hosts) as each completes.
+
+        A cell whose lookup fails is logged and skipped.
+        """
+        with ThreadPoolExecutor(self.nprocs) as cells:
+            futures = {}
+            for cellname in cellnames:
+                futures[cells.submit(self.lookup, cellname)] = cellname
+            try:
+                for future in as_completed(futures):
+                    try:
+                        hosts = future.result()
+                    except Exception as e:
+                        log.error("DNS lookup of cell %s failed: %s", futures[future], e)
+                        continue
+                    yield (futures[future], hosts)
+            finally:
+                for future in futures:
+                    future.cancel() # when closed early
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,159 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+
+"""Per host probe timeouts and retries
+
+Each host keeps a smoothed round trip time, its variance and an estimate of
+the fraction of requests lost, updated from the probe replies the way TCP
+estimates its retransmission timeout (RFC 6298). The first request to a
+host is retried after about as long as its replies are expected to take,
+and the retries wait at least the default timeout, since the replies may
+be slowed by a busy network or prober. Hosts are retried once, and lossy
+hosts up to the default number of retries; slow hosts are given up to one
+and a half times the default timeout. Hosts which did not reply to their
+last probes are probed once, so they fail fast, and hosts without a history
+get the default timeout and retries.
+
+Example:
+
+    estimator = Estimator(timeout=2.0, retries=2)
+    estimator.load(session)
+    timeouts = estimator.timeouts(address)
+    version,rtt,tries = rx.probe(address, port, timeouts)
+    estimator.observe(address, rtt, tries, version is not None)
+    estimator.save(session)
+"""
+
+import logging, math, threading
+from sqlalchemy import select, bindparam, or_
+from avdb.model import Host
+
+log = logging.getLogger('avdb')
+
+ALPHA = 1.0 / 8   # smoothed rtt gain
+BETA = 1.0 / 4    # rtt variance gain
+K = 4             # rtt variances in the timeout
+LOSS_GAIN = 1.0 / 8
+DEAD_AFTER = 2    # probes without a reply before a host is taken to be down
+TARGET_LOSS = 0.01 # acceptable chance of losing every try of a probe
+
+class Estimator(object):
+    """Round trip time and loss estimates of the hosts probed."""
+
+    def __init__(self, timeout=2.0, retries=2):
+        self.timeout = timeout
+        self.retries = retries
+        self.min_timeout = timeout / 2
+        self.max_timeout = 1.5 * timeout # for slow hosts
+        self.hosts = {} # address -> [srtt, rttvar, loss, failures]
+        self.changed = set()
+        self.lock = threading.Lock()
+
+    def load(self, session):
+        """Read the estimates of the hosts which have been probed."""
+        host = Host.__table__
+        query = select([host.c.address, host.c.srtt, host.c.rttvar, host.c.loss,
+                        host.c.failures]) \
+                .where(or_(host.c.srtt != None, host.c.failures > 0))
+        hosts = {}
+        for address,srtt,rttvar,loss,failures in session.execute(query):
+            hosts[address] = [srtt, rttvar, loss or 0.0, failures or 0]
+        session.commit()
+        with self.lock:
+            self.hosts = hosts
+            self.changed.clear()
+        log.info("loaded round trip times of %d hosts", len(hosts))
+
+    def rto(self, address):
+        """The expected time of a reply from the host, or None if unknown."""
+        stats = self.hosts.get(address)
+        if stats is None or stats[0] is None:
+            return None
+        srtt,rttvar = stats[0],stats[1]
+        return min(max(srtt + K * rttvar, self.min_timeout), self.max_timeout)
+
+    def timeouts(self, address):
+        """Get the timeout of each try of a probe of the host."""
+        stats = self.hosts.get(address)
+        rto = self.rto(address)
+        if stats is not None and stats[3] >= DEAD_AFTER:
+            return (min(rto or self.timeout, self.timeout),)
+        if rto is None:
+            return (self.timeout,) * (self.retries + 1)
+        loss = stats[2]
+        if loss <= 0.0:
+            tries = 1
+        elif loss >= 1.0:
+            tries = self.retries + 1
+        else:
+            tries = int(math.ceil(math.log(TARGET_LOSS) / math.log(loss)))
+        # A single lost packet should not fail the probe of a healthy host,
+        # unless no retries are wanted at all.
+        tries = min(max(tries, 2 if self.retries else 1), self.retries + 1)
+        # A late reply to the first request is still taken while waiting
+        # for a retry, so a lost request is retried early, and the extra
+        # time of slow hosts is given to the retries.
+        return (min(rto, self.timeout),) + (max(rto, self.timeout),) * (tries - 1)
+
+    def observe(self, address, rtt, tries, replied):
+        """Update the estimates of a host from a probe.
+
+        The rtt is the time from the last request to the reply; it is not
+        used when requests were repeated, since the reply may have been to
+        an earlier one.
+        """
+        with self.lock:
+            stats = self.hosts.get(address)
+            if stats is None:
+                stats = self.hosts[address] = [None, None, 0.0, 0]
+            if not replied:
+                stats[3] += 1
+            else:
+                stats[3] = 0
+                loss = stats[2]
+                for _ in range(tries - 1):
+                    loss += LOSS_GAIN * (1.0 - loss)
+                stats[2] = loss * (1.0 - LOSS_GAIN)
+                if rtt is not None and tries == 1:
+                    if stats[0] is None:
+                        stats[0] = rtt
+                        stats[1] = rtt / 2
+                    else:
+                        stats[1] = (1 - BETA) * stats[1] + BETA * abs(stats[0] - rtt)
+                        stats[0] = (1 - ALPHA) * stats[0] + ALPHA * rtt
+            self.changed.add(address)
+
+    def save(self, session):
+        """Write the changed estimates; the caller commits."""
+        host = Host.__table__
+        rows = []
+        with self.lock:
+            for address in self.changed:
+                srtt,rttvar,loss,failures = self.hosts[address]
+                rows.append({'b_address':address, 'b_srtt':srtt, 'b_rttvar':rttvar,
+                             'b_loss':loss, 'b_failures':failures})
+            self.changed.clear()
+        if rows:
+            update = host.update().where(host.c.address == bindparam('b_address')) \
+                .values(srtt=bindparam('b_srtt'), rttvar=bindparam('b_rttvar'),
+                        loss=bindparam('b_loss'), failures=bindparam('b_failures'))
+            session.execute(update, rows)
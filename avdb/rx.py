@@ -0,0 +1,145 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Rx debug version probe
+
+This module speaks just enough of the Rx protocol to ask a remote AFS server
+for its version string, the same way 'rxdebug <host> <port> -version' does,
+without forking an external program for each server.
+
+Example:
+
+    >>> rx.get_version('207.89.43.108', 7003)
+    'OpenAFS 1.6.20 2016-12-14 ...'
+"""
+
+import logging, random, select, socket, struct, time
+
+log = logging.getLogger('avdb')
+
+RX_PACKET_TYPE_VERSION = 13
+RX_CLIENT_INITIATED = 1
+RX_LAST_PACKET = 4
+
+# epoch, cid, callNumber, seq, serial, type, flags, userStatus,
+# securityIndex, spare, serviceId
+RX_HEADER = struct.Struct('!IIIIIBBBBHH')
+
+# The rx_debugIn payload rxdebug sends with the version request.
+RX_DEBUGI_GETSTATS = 1
+RX_DEBUGIN = struct.Struct('!ii')
+
+RX_EPOCH = 999 # Same as rxdebug.
+
+def new_call_number():
+    """Pick a call number to match a reply to its request."""
+    return random.randint(1, 0xffffffff)
+
+def version_request(call_number):
+    """Build a version request packet."""
+    header = RX_HEADER.pack(
+        RX_EPOCH, 0, call_number, 0, 0,
+        RX_PACKET_TYPE_VERSION, RX_CLIENT_INITIATED | RX_LAST_PACKET,
+        0, 0, 0, 0)
+    return header + RX_DEBUGIN.pack(RX_DEBUGI_GETSTATS, 0)
+
+def call_number(packet):
+    """Get the call number of a version reply, or None if not a version reply."""
+    if len(packet) <= RX_HEADER.size:
+        return None
+    fields = RX_HEADER.unpack_from(packet)
+    if fields[5] != RX_PACKET_TYPE_VERSION:
+        return None
+    return fields[2]
+
+def parse_version_reply(packet):
+    """Extract the version string from a version reply packet."""
+    data = packet[RX_HEADER.size:].split(b'\0', 1)[0]
+    version = data.decode('utf-8', 'replace').strip()
+    return version or None
+
+def probe(address, port, timeouts=(2.0, 2.0, 2.0)):
+    """Get the version string from the remote host, with the probe timing.
+
+    Sends a version request for each timeout, until one is answered within
+    its timeout. Returns the version string, the time from the last request
+    to the reply, and the number of requests sent. The version and time are
+    None if the host did not reply.
+    """
+    number = new_call_number()
+    request = version_request(number)
+    tries = 0
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for timeout in timeouts:
+            sock.sendto(request, (address, port))
+            tries += 1
+            start = time.time()
+            while True:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break # timed out; try again
+                readable,_,_ = select.select([sock], [], [], remaining)
+                if not readable:
+                    break
+                packet,peer = sock.recvfrom(2048)
+                if peer[0] == address and call_number(packet) == number:
+                    return (parse_version_reply(packet), time.time() - start, tries)
+    except (socket.error, socket.gaierror) as e:
+        log.debug("rx version probe of %s:%s failed: %s", address, port, e)
+    finally:
+        sock.close()
+    return (None, None, tries)
+
+def get_version(address, port, timeout=2.0, retries=2):
+    """Get the version string from the remote host.
+
+    Sends up to retries+1 version requests, waiting timeout seconds for
+    each reply. Returns None if the host did not reply.
+    """
+    return probe(address, port, (timeout,) * (retries + 1))[0]
+
+def rxdebug_version(address, port, timeout=None, retries=0, **kwargs):
+    """Get the version string by running the OpenAFS rxdebug program.
+
+    rxdebug has no timeout option, so the program is stopped if it takes
+    longer than the time allowed for all the tries.
+    """
+    import sh
+    from sh import rxdebug # Resolved on first use; rxdebug may not be installed.
+    version = None
+    prefix = "AFS version:"
+    options = {}
+    if timeout:
+        options['_timeout'] = timeout * (retries + 1)
+    try:
+        for line in rxdebug(address, port, '-version', **options):
+            if line.startswith(prefix):
+                version = line.replace(prefix,'').strip()
+    except (sh.ErrorReturnCode, sh.TimeoutException) as e:
+        log.debug("rxdebug version probe of %s:%s failed: %s", address, port, e)
+        version = None
+    return version
+
+probers = {
+    'native': get_version,
+    'rxdebug': rxdebug_version,
+}
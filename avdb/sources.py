@@ -0,0 +1,283 @@
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""Differential import of CellServDB sources
+
+The hash of each source and a snapshot of the cells and hosts it listed are
+kept in the database. A source which has not changed since it was last
+imported is skipped. For a changed source, only the differences from its
+snapshot are applied: new cells and hosts are added, a host listed under a
+new address keeps its row, and the nodes of hosts which are no longer listed
+by any source are deactivated and marked as unlisted. The hosts found in DNS
+by 'avdb scan' are kept as the source named 'dns', so they are not
+deactivated. When a source lists an unlisted host again its nodes are made
+active again; nodes deactivated by the operator are left as they are. Hosts
+are never deleted, so their version history is kept.
+
+Example:
+
+    importer = Importer(session)
+    sources = Sources(session, importer)
+    changes = sources.add('/tmp/CellServDB')
+    importer.commit()
+    sources.finish()
+"""
+
+import datetime, hashlib, logging
+from collections import OrderedDict
+from sqlalchemy import select
+from avdb.model import Cell, Node, Source, SourceCell, SourceHost, chunks
+from avdb.csdb import openfile, iterparse
+
+log = logging.getLogger('avdb')
+
+# The name of the source of the hosts found in DNS.
+DNS = 'dns'
+
+class Changes(object):
+    """The differences found in a source since its last import."""
+
+    def __init__(self, name):
+        self.name = name
+        self.unchanged = False
+        self.cells_added = []   # cell names
+        self.cells_removed = [] # cell names
+        self.cells_changed = [] # (cell name, old desc, new desc)
+        self.hosts_added = []   # (cell name, address, hostname)
+        self.hosts_removed = [] # (cell name, address, hostname)
+        self.hosts_moved = []   # (cell name, hostname, old address, new address)
+
+    def summary(self):
+        if self.unchanged:
+            return "source {0} is unchanged".format(self.name)
+        return "source {0}: {1} cells added, {2} removed, {3} changed; " \
+               "{4} hosts added, {5} removed, {6} moved".format(
+                   self.name, len(self.cells_added), len(self.cells_removed),
+                   len(self.cells_changed), len(self.hosts_added),
+                   len(self.hosts_removed), len(self.hosts_moved))
+
+    def lines(self):
+        """Describe each change, one per line."""
+        for name in self.cells_added:
+            yield "+ cell {0}".format(name)
+        for name in self.cells_removed:
+            yield "- cell {0}".format(name)
+        for name,old,new in self.cells_changed:
+            yield "~ cell {0} '{1}' -> '{2}'".format(name, old, new)
+        for cell,address,hostname in self.hosts_added:
+            yield "+ host {0} {1} {2}".format(cell, address, hostname)
+        for cell,address,hostname in self.hosts_removed:
+            yield "- host {0} {1} {2}".format(cell, address, hostname)
+        for cell,hostname,old,new in self.hosts_moved:
+            yield "~ host {0} {1} {2} -> {3}".format(cell, hostname, old, new)
+
+def _hashed(lines, digest):
+    """Pass the lines through, adding them to the digest."""
+    for line in lines:
+        digest.update(line if isinstance(line, bytes) else line.encode('utf-8'))
+        yield line
+
+class Sources(object):
+    """Import CellServDB sources, applying only what changed."""
+
+    def __init__(self, session, importer, force=False):
+        self.session = session
+        self.importer = importer
+        self.force = force
+        self.removed = set() # addresses no longer listed by a source
+        self.dns_id = None   # id of the dns source
+
+    def read(self, path):
+        """Read and parse a source.
+
+        Returns the content hash and an OrderedDict of cell name to
+        (desc, OrderedDict of address to hostname).
+        """
+        digest = hashlib.sha256()
+        cells = OrderedDict()
+        with openfile(path) as f:
+            for cellname,desc,hosts in iterparse(_hashed(f, digest)):
+                if cellname == 'dynroot':
+                    continue  # skip the synthetic cellname
+                if cellname not in cells:
+                    cells[cellname] = (desc, OrderedDict())
+                cells[cellname][1].update(hosts)
+        return (digest.hexdigest(), cells)
+
+    def add(self, path, name=None):
+        """Import a source unless it is unchanged; returns the Changes."""
+        session = self.session
+        name = name or path
+        digest,cells = self.read(path)
+        changes = Changes(name)
+        source = session.query(Source).filter_by(name=name).first()
+        if source is not None and source.digest == digest and not self.force:
+            changes.unchanged = True
+            log.info(changes.summary())
+            return changes
+        if source is None:
+            source = Source(name=name)
+            session.add(source)
+            session.flush()
+        self._apply(source.id, cells, changes)
+        source.digest = digest
+        source.imported = datetime.datetime.now()
+        log.info(changes.summary())
+        return changes
+
+    def _apply(self, source_id, cells, changes):
+        session = self.session
+        importer = self.importer
+        sc = SourceCell.__table__
+        sh = SourceHost.__table__
+        query = select([sc.c.id, sc.c.name, sc.c.desc]).where(sc.c.source_id == source_id)
+        old_cells = dict((name, (id_, desc)) for id_,name,desc in session.execute(query))
+        query = select([sh.c.id, sh.c.cell, sh.c.address, sh.c.name]) \
+                .where(sh.c.source_id == source_id)
+        old_hosts = dict(((cell, address), (id_, hostname))
+                         for id_,cell,address,hostname in session.execute(query))
+
+        # Cells.
+        new_cell_rows = []
+        for cellname,(desc,_) in cells.items():
+            old = old_cells.get(cellname)
+            if old is None:
+                importer.add_cell(cellname, desc=desc)
+                changes.cells_added.append(cellname)
+                new_cell_rows.append({'source_id':source_id, 'name':cellname, 'desc':desc})
+            elif old[1] != desc:
+                changes.cells_changed.append((cellname, old[1], desc))
+                session.execute(sc.update().where(sc.c.id == old[0]).values(desc=desc))
+                session.execute(Cell.__table__.update()
+                                .where(Cell.__table__.c.name == cellname).values(desc=desc))
+        gone = [(name, id_) for name,(id_,_) in old_cells.items() if name not in cells]
+        changes.cells_removed.extend(sorted(name for name,_ in gone))
+        for chunk in chunks([id_ for _,id_ in gone]):
+            session.execute(sc.delete().where(sc.c.id.in_(chunk)))
+        if new_cell_rows:
+            session.execute(sc.insert(), new_cell_rows)
+
+        # Hosts.
+        new_hosts = OrderedDict()
+        for cellname,(_,hosts) in cells.items():
+            for address,hostname in hosts.items():
+                new_hosts[(cellname, address)] = hostname
+        added = [(key, hostname) for key,hostname in new_hosts.items() if key not in old_hosts]
+        removed = [(key, value) for key,value in old_hosts.items() if key not in new_hosts]
+        renamed = [(old_hosts[key][0], hostname) for key,hostname in new_hosts.items()
+                   if key in old_hosts and old_hosts[key][1] != hostname]
+        moved = dict(((cell, hostname), address) for (cell,address),(_,hostname) in removed
+                     if hostname)
+        kept = self._listed_elsewhere(list(moved.values()), [id_ for _,(id_,_) in removed])
+        renumbered = set()
+        for (cellname,address),hostname in added:
+            old_address = moved.pop((cellname, hostname), None) if hostname else None
+            if old_address:
+                changes.hosts_moved.append((cellname, hostname, old_address, address))
+                if old_address not in kept and importer.move_host(old_address, address):
+                    renumbered.add(old_address)
+            else:
+                changes.hosts_added.append((cellname, address, hostname))
+            importer.add_host(cellname, address, hostname)
+        for (cellname,address),(_,hostname) in removed:
+            if moved.get((cellname, hostname)) == address or not hostname:
+                changes.hosts_removed.append((cellname, address, hostname))
+            if address not in renumbered:
+                self.removed.add(address)
+        for chunk in chunks([id_ for _,(id_,_) in removed]):
+            session.execute(sh.delete().where(sh.c.id.in_(chunk)))
+        for id_,hostname in renamed:
+            session.execute(sh.update().where(sh.c.id == id_).values(name=hostname))
+        if added:
+            rows = [{'source_id':source_id, 'cell':cellname, 'address':address, 'name':hostname}
+                    for (cellname,address),hostname in added]
+            session.execute(sh.insert(), rows)
+
+    def _unlisted(self, addresses):
+        """Get the addresses which no source lists."""
+        sh = SourceHost.__table__
+        listed = set()
+        for chunk in chunks(sorted(set(addresses))):
+            query = select([sh.c.address]).where(sh.c.address.in_(chunk))
+            listed.update(row[0] for row in self.session.execute(query))
+        return set(addresses) - listed
+
+    def _listed_elsewhere(self, addresses, ignore):
+        """Get the addresses listed by a source row other than the ignored ones."""
+        sh = SourceHost.__table__
+        ignore = set(ignore)
+        listed = set()
+        for chunk in chunks(sorted(set(addresses))):
+            query = select([sh.c.id, sh.c.address]).where(sh.c.address.in_(chunk))
+            listed.update(address for id_,address in self.session.execute(query)
+                          if id_ not in ignore)
+        return listed
+
+    def found(self, cellname, hosts):
+        """Record the hosts of a cell found in DNS, as the source named 'dns'.
+
+        The hosts are added like those of a CellServDB source, so the nodes
+        deactivated for not being listed are made active again. A lookup which
+        found no hosts leaves the snapshot of the cell as it was, since the
+        lookup may have failed.
+        """
+        session = self.session
+        sh = SourceHost.__table__
+        if self.dns_id is None:
+            source = session.query(Source).filter_by(name=DNS).first()
+            if source is None:
+                source = Source(name=DNS)
+                session.add(source)
+                session.flush()
+            self.dns_id = source.id
+        if not hosts:
+            return
+        hosts = OrderedDict(hosts)
+        query = select([sh.c.id, sh.c.address, sh.c.name]) \
+                .where((sh.c.source_id == self.dns_id) & (sh.c.cell == cellname))
+        old = dict((address, (id_, hostname))
+                   for id_,address,hostname in session.execute(query).fetchall())
+        for address,hostname in hosts.items():
+            self.importer.add_host(cellname, address, hostname)
+        gone = [id_ for address,(id_,_) in old.items() if address not in hosts]
+        for chunk in chunks(gone):
+            session.execute(sh.delete().where(sh.c.id.in_(chunk)))
+        rows = [{'source_id':self.dns_id, 'cell':cellname, 'address':a, 'name':h}
+                for a,h in hosts.items() if a not in old]
+        if rows:
+            session.execute(sh.insert(), rows)
+
+    def finish(self):
+        """Deactivate the hosts which are no longer listed by any source.
+
+        Call after all the sources have been added, so a host which moved
+        from one source to another is kept. Only active nodes are
+        deactivated, and they are marked so a source listing their host
+        again reactivates them. Returns the number of nodes deactivated.
+        """
+        session = self.session
+        count = 0
+        for chunk in chunks(sorted(self._unlisted(self.removed))):
+            log.info("deactivating hosts no longer listed: %s", ' '.join(chunk))
+            count += Node.set_listed(session, False, chunk)
+        session.commit()
+        self.removed.clear()
+        return count
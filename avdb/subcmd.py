@@ -48,7 +48,7 @@ Example:
 """
 
 from __future__ import print_function
-import argparse, logging, os
+import argparse, datetime, logging, os
 try:
     from configparser import ConfigParser # python3
 except ImportError:
@@ -103,6 +103,27 @@ def argument(*name_or_flags, **options):
     """Helper to declare subcommand arguments."""
     return (name_or_flags, options)
 
+def duration(text):
+    """Convert a duration such as '90', '15m', '6h' or '7d' to seconds."""
+    units = {'s':1, 'm':60, 'h':3600, 'd':86400, 'w':7*86400}
+    text = str(text).strip().lower()
+    try:
+        if text and text[-1] in units:
+            return float(text[:-1]) * units[text[-1]]
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid duration: '{0}'".format(text))
+
+def timestamp(text):
+    """Convert a date such as '2017-06-01' or '2017-06-01 12:30' to a datetime."""
+    text = str(text).strip().replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date: '{0}'".format(text))
+
 def usage(msg):
     """Print a summary of the subcommands."""
     print("{msg}\ncommands:".format(msg=msg))
@@ -1,15 +1,22 @@
 #
 # Report templates
 #
+# Reports are written in three parts, so rows can be streamed to the
+# output: the header, one row per result, and the footer.
+#
 
 template = {
 
-    'csv':"""\
-{{#results}}
-{{cell.name}},{{host.address}},{{node.name}},{{version.added}},"{{version.version}}"
-{{/results}}""",
+    'csv':{
+        'header':"",
+        'row':"""\
+{{cell}},{{address}},{{node}},{{added}},"{{version}}"
+""",
+        'footer':"",
+    },
 
-    'html':"""\
+    'html':{
+        'header':"""\
 <!DOCTYPE html>
 <html>
 <head>
@@ -47,19 +54,22 @@ td {
 </tr>
 </thead>
 <tbody>
-{{#results}}
+""",
+        'row':"""\
 <tr>
-<td>{{cell.name}}</td>
-<td>{{host.address}}</td>
-<td>{{node.name}}</td>
-<td>{{version.added}}</td>
-<td>{{version.version}}</td>
+<td>{{cell}}</td>
+<td>{{address}}</td>
+<td>{{node}}</td>
+<td>{{added}}</td>
+<td>{{version}}</td>
 </tr>
-{{/results}}
+""",
+        'footer':"""\
 </tbody>
 </table>
 
 <p>rendered on {{generated}}</p>
 </body>
 </html>""",
+    },
 }
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Time avdb against a simulated fleet.
+
+Starts the fake fleet and the stub DNS server, then for each size writes a
+synthetic CellServDB and times import, the DNS and probe phases of scan,
+and report, on a new sqlite database. Requires Linux and Python 3.
+
+    $ python benchmarks/bench.py --nodes 1000 10000 100000 --latency 20 --silent 0.05
+"""
+
+import argparse, json, logging, multiprocessing, os, shutil, subprocess, sys, tempfile, time
+import gencsdb
+from queue import Empty
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+# avdb creates its database engine once per process, so each size is run in
+# a new process.
+
+def run_size(args, nodes, workdir, results):
+    import avdb
+    from avdb.model import Session, ScanRun
+    from avdb.metrics import metrics
+    logging.getLogger('avdb').setLevel(logging.ERROR)
+    hosts = nodes // 2 # A ptserver and a vlserver on each host.
+    ncells = max(1, -(-hosts // args.hosts_per_cell))
+    csdb = os.path.join(workdir, 'CellServDB.{0}'.format(nodes))
+    with open(csdb, 'w') as out:
+        gencsdb.write(out, ncells, args.hosts_per_cell)
+    url = 'sqlite:///' + os.path.join(workdir, 'avdb.{0}.db'.format(nodes))
+    result = {'nodes': ncells * args.hosts_per_cell * 2, 'cells': ncells}
+
+    start = time.time()
+    avdb.import_(csdb=[csdb], url=url)
+    result['import'] = time.time() - start
+
+    metrics.reset()
+    start = time.time()
+    avdb.scan_(url=url, engine=args.engine, nprocs=args.nprocs,
+               concurrency=args.concurrency, timeout=args.timeout, retries=args.retries,
+               nameservers='127.0.0.1', dns_port=args.dns_port)
+    result['scan'] = time.time() - start
+    run = Session().query(ScanRun).order_by(ScanRun.id.desc()).first()
+    result['dns'] = run.dns_seconds
+    result['probe'] = run.probe_seconds
+    result['nodes_per_second'] = run.nodes_per_second
+    result['replies'] = run.replies
+    result['failures'] = run.failures
+
+    output = os.path.join(workdir, 'report.html')
+    start = time.time()
+    avdb.report_(format='html', output=output, url=url)
+    result['report'] = time.time() - start
+    start = time.time()
+    avdb.report_(format='html', output=output, current=True, url=url)
+    result['report_current'] = time.time() - start
+    results.put(result)
+
+def start_servers(args, max_nodes):
+    hosts = max_nodes // 2
+    ncells = -(-hosts // args.hosts_per_cell)
+    fleet = subprocess.Popen([sys.executable, os.path.join(HERE, 'fakefleet.py'),
+                              '--hosts', str(ncells * args.hosts_per_cell),
+                              '--latency', str(args.latency), '--jitter', str(args.jitter),
+                              '--loss', str(args.loss), '--silent', str(args.silent)])
+    dns = subprocess.Popen([sys.executable, os.path.join(HERE, 'stubdns.py'),
+                            '--cells', str(ncells), '--hosts-per-cell', str(args.hosts_per_cell),
+                            '--port', str(args.dns_port)])
+    time.sleep(1.0) # Let them bind.
+    servers = [fleet, dns]
+    if any(server.poll() is not None for server in servers):
+        stop_servers(servers)
+        raise RuntimeError("benchmark servers failed to start")
+    return servers
+
+def stop_servers(servers):
+    for server in servers:
+        if server.poll() is None:
+            server.terminate()
+        server.wait()
+
+COLUMNS = (
+    # result key, heading, format
+    ('nodes', 'nodes', '{0:>8}'),
+    ('import', 'import', '{0:>8.2f}'),
+    ('dns', 'dns', '{0:>8.2f}'),
+    ('probe', 'probe', '{0:>8.2f}'),
+    ('scan', 'scan', '{0:>8.2f}'),
+    ('nodes_per_second', 'nodes/s', '{0:>8.0f}'),
+    ('report', 'report', '{0:>8.2f}'),
+    ('report_current', 'current', '{0:>8.2f}'),
+)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="fleet sizes to time, in nodes")
+    parser.add_argument('--hosts-per-cell', type=int, default=3, help="hosts in each cell")
+    parser.add_argument('--latency', type=float, default=0.0, help="mean reply delay in milliseconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra delay in milliseconds")
+    parser.add_argument('--loss', type=float, default=0.0, help="fraction of requests dropped")
+    parser.add_argument('--silent', type=float, default=0.0, help="fraction of hosts which never reply")
+    parser.add_argument('--engine', choices=['mpipe', 'async'], default='async', help="probe engine")
+    parser.add_argument('--nprocs', type=int, default=10, help="number of processes (mpipe engine)")
+    parser.add_argument('--concurrency', type=int, default=1000, help="outstanding probes (async engine)")
+    parser.add_argument('--timeout', type=float, default=1.0, help="seconds to wait for each probe reply")
+    parser.add_argument('--retries', type=int, default=1, help="probe retries per node")
+    parser.add_argument('--dns-port', type=int, default=15353, help="stub dns server port")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the work directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='avdb-bench-')
+    servers = start_servers(args, max(args.nodes))
+    results = []
+    try:
+        print(' '.join('{0:>8}'.format(heading) for _,heading,_ in COLUMNS))
+        for nodes in args.nodes:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_size, args=(args, nodes, workdir, queue))
+            process.start()
+            while True:
+                try:
+                    result = queue.get(timeout=1.0)
+                    break
+                except Empty:
+                    if not process.is_alive():
+                        raise RuntimeError("benchmark of {0} nodes failed".format(nodes))
+            process.join()
+            results.append(result)
+            print(' '.join(fmt.format(result[key] or 0) for key,_,fmt in COLUMNS))
+            sys.stdout.flush()
+    finally:
+        stop_servers(servers)
+        if args.keep:
+            print("work directory: {0}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
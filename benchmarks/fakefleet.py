@@ -0,0 +1,156 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Simulated fleet of AFS database servers.
+
+Answers Rx version requests sent to any of the fleet addresses (127.16.0.0
+and up) on the ptserver and vlserver ports. One socket per port serves every
+address; replies are sent from the address the request was sent to with
+IP_PKTINFO, so this requires Linux. Replies may be delayed, dropped, or
+never sent by hosts chosen to be silent.
+
+    $ python benchmarks/fakefleet.py --hosts 5000 --latency 20 --loss 0.01 --silent 0.05
+"""
+
+import argparse, heapq, itertools, logging, os, random, select, socket, struct, sys, time
+import synth
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from avdb import rx
+
+log = logging.getLogger('fakefleet')
+
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8) # Linux value
+IN_PKTINFO = struct.Struct('=I4s4s') # ifindex, spec_dst, addr
+
+def version_reply(request, version):
+    """Build the reply to a version request."""
+    fields = list(rx.RX_HEADER.unpack_from(request))
+    fields[6] = 0 # flags
+    return rx.RX_HEADER.pack(*fields) + version.encode('utf-8') + b'\0'
+
+class Fleet(object):
+    """Rx version responders for a range of simulated hosts."""
+
+    def __init__(self, nhosts, ports=(7002, 7003), latency=0.0, jitter=0.0,
+                 loss=0.0, silent=0.0):
+        self.nhosts = nhosts
+        self.ports = ports
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.silent = silent
+        self.socks = []
+        self.queue = [] # (due, seq, sock, reply, peer, source)
+        self.seq = itertools.count()
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+
+    def open(self, address='0.0.0.0'):
+        for port in self.ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind((address, port))
+            sock.setblocking(False)
+            self.socks.append(sock)
+        log.info("serving %d hosts (%s to %s) on ports %s", self.nhosts,
+                 synth.address(0), synth.address(self.nhosts - 1),
+                 ','.join(str(p) for p in self.ports))
+
+    def delay(self, n):
+        """Pick the reply delay of host number n, in seconds."""
+        delay = self.latency * (0.5 + synth.choice(n, 'latency'))
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        return delay
+
+    def receive(self, sock):
+        while True:
+            try:
+                data,ancdata,_,peer = sock.recvmsg(2048, socket.CMSG_SPACE(IN_PKTINFO.size))
+            except (BlockingIOError, InterruptedError):
+                return
+            destination = None
+            for level,kind,value in ancdata:
+                if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                    destination = socket.inet_ntoa(IN_PKTINFO.unpack(value)[2])
+            self.requests += 1
+            if destination is None or rx.call_number(data) is None:
+                continue
+            n = synth.host_number(destination)
+            if n is None or n >= self.nhosts or synth.choice(n, 'silent') < self.silent:
+                continue
+            if self.loss and random.random() < self.loss:
+                self.dropped += 1
+                continue
+            reply = version_reply(data, synth.version(n))
+            due = time.time() + self.delay(n)
+            heapq.heappush(self.queue, (due, next(self.seq), sock, reply, peer, destination))
+
+    def send(self, now):
+        while self.queue and self.queue[0][0] <= now:
+            _,_,sock,reply,peer,source = heapq.heappop(self.queue)
+            pktinfo = IN_PKTINFO.pack(0, socket.inet_aton(source), b'\0\0\0\0')
+            try:
+                sock.sendmsg([reply], [(socket.IPPROTO_IP, IP_PKTINFO, pktinfo)], 0, peer)
+                self.replies += 1
+            except OSError as e:
+                log.debug("send to %s failed: %s", peer, e)
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.queue:
+                timeout = max(0.0, self.queue[0][0] - time.time())
+            readable,_,_ = select.select(self.socks, [], [], timeout)
+            for sock in readable:
+                self.receive(sock)
+            self.send(time.time())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=3000, help="number of simulated hosts")
+    parser.add_argument('--latency', type=float, default=0.0, help="mean reply delay in milliseconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra delay in milliseconds")
+    parser.add_argument('--loss', type=float, default=0.0, help="fraction of requests dropped")
+    parser.add_argument('--silent', type=float, default=0.0, help="fraction of hosts which never reply")
+    parser.add_argument('--ports', default='7002,7003', help="comma separated ports")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.hosts > synth.MAX_HOSTS:
+        parser.error("at most {0} hosts".format(synth.MAX_HOSTS))
+    ports = [int(p) for p in args.ports.split(',')]
+    fleet = Fleet(args.hosts, ports=ports, latency=args.latency / 1000.0,
+                  jitter=args.jitter / 1000.0, loss=args.loss, silent=args.silent)
+    fleet.open()
+    try:
+        fleet.run()
+    except KeyboardInterrupt:
+        log.info("%d requests, %d replies, %d dropped", fleet.requests,
+                 fleet.replies, fleet.dropped)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Write a synthetic CellServDB file for the fake fleet."""
+
+import argparse, sys
+import synth
+
+def write(out, ncells, hosts_per_cell):
+    for cell,(name,hosts) in enumerate(synth.cells(ncells, hosts_per_cell)):
+        out.write('>{0}    #Benchmark cell {1}\n'.format(name, cell))
+        for address,hostname in hosts:
+            out.write('{0}                  #{1}\n'.format(address, hostname))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cells', type=int, default=1000, help="number of cells")
+    parser.add_argument('--hosts-per-cell', type=int, default=3, help="hosts in each cell")
+    parser.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = parser.parse_args()
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        write(out, args.cells, args.hosts_per_cell)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
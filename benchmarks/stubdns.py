@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Stub DNS server for the simulated cells.
+
+Answers the AFSDB, SRV and A queries made by 'avdb scan' for the cells
+written by gencsdb.py. Records are computed from the query name, so the
+zone may be of any size.
+
+    $ python benchmarks/stubdns.py --cells 1000 --port 5353
+    $ avdb scan --nameservers 127.0.0.1 --dns-port 5353
+"""
+
+import argparse, logging, re, socket, sys
+import dns.flags, dns.message, dns.rcode, dns.rdatatype, dns.rrset
+import synth
+
+log = logging.getLogger('stubdns')
+
+class Zone(object):
+    """Records of the simulated cells."""
+
+    def __init__(self, ncells, hosts_per_cell, srv=True, ttl=3600, domain=synth.DOMAIN):
+        self.ncells = ncells
+        self.hosts_per_cell = hosts_per_cell
+        self.srv = srv
+        self.ttl = ttl
+        domain = re.escape(domain)
+        self.cell_re = re.compile(r'cell(\d+)\.' + domain + r'\.$')
+        self.srv_re = re.compile(r'_afs3-(vl|pr)server\._udp\.cell(\d+)\.' + domain + r'\.$')
+        self.host_re = re.compile(r'afsdb(\d+)\.cell(\d+)\.' + domain + r'\.$')
+
+    def _cell(self, text):
+        cell = int(text)
+        return cell if cell < self.ncells else None
+
+    def records(self, name, rdtype):
+        """Get the record texts for a query; None if the name does not exist."""
+        name = name.lower()
+        if rdtype == 'AFSDB':
+            m = self.cell_re.match(name)
+            if m and self._cell(m.group(1)) is not None:
+                cell = int(m.group(1))
+                return ['1 {0}.'.format(synth.hostname(cell, h))
+                        for h in range(self.hosts_per_cell)]
+        elif rdtype == 'SRV':
+            m = self.srv_re.match(name)
+            if m and self.srv and self._cell(m.group(2)) is not None:
+                cell = int(m.group(2))
+                port = 7003 if m.group(1) == 'vl' else 7002
+                return ['0 0 {0} {1}.'.format(port, synth.hostname(cell, h))
+                        for h in range(self.hosts_per_cell)]
+        elif rdtype == 'A':
+            m = self.host_re.match(name)
+            if m and self._cell(m.group(2)) is not None:
+                host = int(m.group(1))
+                if host < self.hosts_per_cell:
+                    n = int(m.group(2)) * self.hosts_per_cell + host
+                    return [synth.address(n)]
+        return None
+
+    def answer(self, wire):
+        """Build the response to a query message."""
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        values = self.records(question.name.to_text(), rdtype)
+        if values:
+            response.answer.append(dns.rrset.from_text_list(
+                question.name, self.ttl, 'IN', rdtype, values))
+        elif values is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        return response.to_wire()
+
+def serve(zone, address='127.0.0.1', port=5353):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((address, port))
+    log.info("serving %d cells on %s:%d", zone.ncells, address, port)
+    while True:
+        wire,peer = sock.recvfrom(4096)
+        try:
+            sock.sendto(zone.answer(wire), peer)
+        except Exception as e:
+            log.warning("bad query from %s: %s", peer, e)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', type=int, default=1000, help="number of cells")
+    parser.add_argument('--hosts-per-cell', type=int, default=3, help="hosts in each cell")
+    parser.add_argument('--no-srv', action='store_true', help="publish only AFSDB records")
+    parser.add_argument('--address', default='127.0.0.1', help="listen address")
+    parser.add_argument('--port', type=int, default=5353, help="listen port")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    zone = Zone(args.cells, args.hosts_per_cell, srv=not args.no_srv)
+    try:
+        serve(zone, args.address, args.port)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2017 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Naming of the simulated cells and hosts
+
+The fake fleet, the stub DNS zone and the synthetic CellServDB files agree
+on these names. Host number n of the fleet is at address 127.16.0.0 + n,
+which is routed to the loopback interface on Linux, and is host n %
+hosts_per_cell of cell n // hosts_per_cell.
+"""
+
+import socket, struct, zlib
+
+DOMAIN = 'bench.test'
+BASE = struct.unpack('!I', socket.inet_aton('127.16.0.0'))[0]
+MAX_HOSTS = 0x7fffffff - BASE
+
+VERSIONS = (
+    'OpenAFS 1.6.20 2016-12-14 builder@example',
+    'OpenAFS 1.6.22 2017-12-07 builder@example',
+    'OpenAFS 1.8.2 2018-09-11 builder@example',
+    'OpenAFS 1.8.5 2019-12-19 builder@example',
+    'AuriStorFS 0.189 2019-06-14 builder@example',
+)
+
+def cellname(cell, domain=DOMAIN):
+    return 'cell{0}.{1}'.format(cell, domain)
+
+def hostname(cell, host, domain=DOMAIN):
+    return 'afsdb{0}.{1}'.format(host, cellname(cell, domain))
+
+def address(n):
+    """Get the address of host number n."""
+    return socket.inet_ntoa(struct.pack('!I', BASE + n))
+
+def host_number(addr):
+    """Get the host number of an address, or None if not in the fleet."""
+    try:
+        n = struct.unpack('!I', socket.inet_aton(addr))[0] - BASE
+    except (socket.error, struct.error):
+        return None
+    if n < 0 or n >= MAX_HOSTS:
+        return None
+    return n
+
+def choice(n, salt=''):
+    """A stable pseudo random number in [0, 1) for host number n."""
+    key = '{0}:{1}'.format(salt, n).encode('ascii')
+    return (zlib.crc32(key) & 0xffffffff) / float(0x100000000)
+
+def version(n):
+    """The version string reported by host number n."""
+    return VERSIONS[int(choice(n, 'version') * len(VERSIONS))]
+
+def cells(ncells, hosts_per_cell):
+    """Yield (cellname, [(address, hostname), ...]) for each cell."""
+    for cell in range(ncells):
+        hosts = []
+        for host in range(hosts_per_cell):
+            n = cell * hosts_per_cell + host
+            hosts.append((address(n), hostname(cell, host)))
+        yield (cellname(cell), hosts)
@@ -52,7 +52,7 @@ def main():
     for client in items(soup, 'clients'):
         log.info("importing cmdebug %s -cellservdb", client)
         cmdebug(client, cellservdb=True, _out='/tmp/avdb.csdb')
-        avdb.import_('/tmp/avdb.csdb')
+        avdb.import_('/tmp/avdb.csdb', source='cmdebug:{0}'.format(client))
     for cellname in items(soup, 'cellnames'):
         log.info("adding %s", cellname)
         avdb.add_(cell=cellname)
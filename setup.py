@@ -17,6 +17,8 @@ setup(
         'mpipe',
         'pystache',
         'dnspython',
+        'futures; python_version < "3"',
+        'ipaddress; python_version < "3"',
     ],
     entry_points={
         'console_scripts': [